@@ -59,5 +59,8 @@ setup(name='eduid-action',
           'actions': actions_extras,
       },
       entry_points={
+          'console_scripts': [
+              'eduid_action_tou_maintenance = eduid_action.tou.maintenance:main',
+          ],
       },
       )
@@ -30,7 +30,11 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 from abc import ABCMeta, abstractmethod
-from flask import current_app
+from flask import current_app, g
+from pymongo.read_preferences import Nearest, PrimaryPreferred, Secondary, SecondaryPreferred
+
+from eduid_userdb.userdb import User
+from eduid_userdb.exceptions import UserDoesNotExist
 
 
 class ActionError(Exception):
@@ -104,6 +108,27 @@ class ActionPlugin(object):
 
     ActionError = ActionError
 
+    # Fields of the central user document needed by the plugin,
+    # or None to load the whole document. See get_user.
+    USER_FIELDS = None
+
+    # Fields that are always loaded, since the User constructor checks them to refuse
+    # loading some users (e.g. revoked_ts for revoked users, passwords for users that
+    # haven't completed signup). Keep in sync with User._parse_check_invalid_users.
+    _MANDATORY_USER_FIELDS = ('_id', 'eduPersonPrincipalName', 'passwords', 'revoked_ts')
+
+    # Read preference to use when loading the user in read-only plugin methods,
+    # by method name, e.g. {'get_config_for_bundle': 'secondaryPreferred'}.
+    # Methods not listed here read from the primary. See get_user.
+    USER_READ_PREFERENCES = {}
+
+    _READ_PREFERENCES = {
+        'primaryPreferred': PrimaryPreferred,
+        'secondary': Secondary,
+        'secondaryPreferred': SecondaryPreferred,
+        'nearest': Nearest,
+    }
+
     class ValidationError(Exception):
         '''
         exception to be raised if some form doesn't validate.
@@ -194,3 +219,66 @@ class ActionPlugin(object):
         :raise: ActionPlugin.ActionError
         :return: dict
         '''
+
+    def get_user(self, action, raise_on_missing=True, method=None):
+        '''
+        Load the user the action is for from the central userdb.
+
+        The user is only loaded once per request (for the same set of fields
+        and read preference), and if the plugin declares the fields it needs in
+        USER_FIELDS, only those fields are read from the database.
+
+        If `method' is given and listed in USER_READ_PREFERENCES, the user is
+        read using that read preference (e.g. from a secondary), with a maximum
+        replication lag of USER_READ_MAX_STALENESS seconds. Callers that can
+        detect stale data should call again without `method' to read from the
+        primary.
+
+        :param action: the action as retrieved from the eduid_actions db
+        :param raise_on_missing: raise UserDoesNotExist if the user is not found
+        :param method: name of the plugin method loading the user
+        :type action: eduid_userdb.actions.Action
+        :type raise_on_missing: bool
+        :type method: str | None
+
+        :return: the user, or None if not found and raise_on_missing is False
+        :rtype: eduid_userdb.User | None
+        '''
+        if action.old_format:
+            spec = {'_id': action.user_id}
+        else:
+            spec = {'eduPersonPrincipalName': action.eppn}
+        fields = None
+        if self.USER_FIELDS is not None:
+            fields = tuple(sorted(set(self._MANDATORY_USER_FIELDS) | set(self.USER_FIELDS)))
+        read_preference = self.USER_READ_PREFERENCES.get(method, 'primary')
+
+        users = g.setdefault('eduid_action_users', {})
+        key = (tuple(spec.items()), fields, read_preference)
+        if key not in users:
+            users[key] = self._load_user(spec, fields, read_preference)
+        user = users[key]
+        if user is None and raise_on_missing:
+            raise UserDoesNotExist('No user matching {!r}'.format(spec))
+        return user
+
+    def _load_user(self, spec, fields, read_preference='primary'):
+        userdb = current_app.central_userdb
+        if fields is None and read_preference == 'primary':
+            if '_id' in spec:
+                return userdb.get_user_by_id(spec['_id'], raise_on_missing=False)
+            return userdb.get_user_by_eppn(spec['eduPersonPrincipalName'], raise_on_missing=False)
+        coll = userdb._coll
+        if read_preference != 'primary':
+            max_staleness = current_app.config.get('USER_READ_MAX_STALENESS', 90)
+            pref = self._READ_PREFERENCES[read_preference](max_staleness=max_staleness)
+            coll = coll.with_options(read_preference=pref)
+        projection = None
+        if fields is not None:
+            projection = {field: True for field in fields}
+        doc = coll.find_one(spec, projection=projection)
+        if doc is None:
+            return None
+        # the same class the userdb would create, checking the user in the same way
+        user_class = getattr(userdb, 'UserClass', User)
+        return user_class(data=doc)
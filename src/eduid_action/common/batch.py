@@ -0,0 +1,112 @@
+#
+# Copyright (c) 2019 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import time
+from itertools import islice
+
+from pymongo.errors import BulkWriteError
+
+# MongoDB error code for writes refused by a unique index
+DUPLICATE_KEY_ERROR = 11000
+
+
+def chunked(iterable, size):
+    '''
+    Split an iterable (e.g. a database cursor) into lists of at most `size'
+    items, without reading more than one chunk into memory at a time.
+
+    :type iterable: iterable
+    :type size: int
+
+    :rtype: generator of lists
+    '''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class RateLimiter(object):
+    '''
+    Limit the rate of some operation to on average `rate' items per second,
+    by sleeping in `wait'.
+
+    :param rate: items per second, or None for no limit
+    :type rate: float | None
+    '''
+
+    def __init__(self, rate=None, timer=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self._timer = timer
+        self._sleep = sleep
+        self._start = None
+        self._count = 0
+
+    def wait(self, count=1):
+        '''
+        Account for `count' items, sleeping first if needed to stay within the rate.
+        '''
+        if not self.rate:
+            return
+        now = self._timer()
+        if self._start is None:
+            self._start = now
+        delay = self._start + self._count / self.rate - now
+        if delay > 0:
+            self._sleep(delay)
+        self._count += count
+
+
+def unordered_bulk_write(coll, requests):
+    '''
+    Write the requests with an unordered bulk write, where the writes refused by
+    a unique index (e.g. upserts losing a race with a concurrent insert of the
+    same document) are not errors.
+
+    :param coll: the collection
+    :param requests: pymongo InsertOne, UpdateOne etc. requests
+    :type coll: pymongo.collection.Collection
+    :type requests: list
+
+    :return: number of documents inserted or upserted
+    :rtype: int
+    '''
+    try:
+        result = coll.bulk_write(requests, ordered=False)
+    except BulkWriteError as exc:
+        errors = [this for this in exc.details.get('writeErrors', []) if this.get('code') != DUPLICATE_KEY_ERROR]
+        if errors or exc.details.get('writeConcernErrors'):
+            raise
+        return exc.details.get('nInserted', 0) + exc.details.get('nUpserted', 0)
+    return result.inserted_count + result.upserted_count
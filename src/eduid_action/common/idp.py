@@ -0,0 +1,375 @@
+#
+# Copyright (c) 2019 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Shared state for the IdP side of the action plugins, used when the IdP calls
+the `add_actions' hooks of all plugins during a login.
+"""
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+from eduid_userdb.actions import Action
+
+from eduid_action.common.batch import unordered_bulk_write
+
+# Threads running the plugin hooks, shared by all logins, see _get_executor
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class HookFailed(Exception):
+    """
+    A fail-closed plugin hook raised an exception or didn't finish in time,
+    so the user can't be allowed to log in.
+    """
+
+    def __init__(self, name, reason):
+        super(HookFailed, self).__init__('Plugin {} add_actions failed: {}'.format(name, reason))
+        self.name = name
+        self.reason = reason
+
+
+def action_spec(eppn, action_type, session=None, params=None):
+    """
+    Filter matching the actions of a user in the actions db, with the field names
+    of the documents written by eduid_userdb.actions.ActionDB.
+
+    :param eppn: the eppn of the user
+    :param action_type: the plugin name
+    :param session: only actions for this SSO session
+    :param params: only actions with exactly these params
+
+    :rtype: dict
+    """
+    spec = {'eppn': eppn,
+            'action': action_type,
+            }
+    if session is not None:
+        spec['session'] = session
+    if params is not None:
+        spec['params'] = params
+    return spec
+
+
+class IdPActionsContext(object):
+    """
+    The actions of a user, shared by the `add_actions' hooks of all plugins
+    during one login, so that the number of queries to the actions db doesn't
+    grow with the number of plugins.
+
+    All the pending actions of the user for the SSO session are read with a
+    single query the first time they are needed, and the actions the plugins
+    add are queued and written with a single bulk write by `flush'. Actions
+    added after the flush are written right away. Plugins that need to know
+    that their actions have been written can register a callback with
+    `on_flush'.
+
+    :param actions_db: The actions database
+    :param eppn: the eppn of the authenticating user
+    :param session: the SSO session key (ticket.key)
+
+    :type actions_db: eduid_userdb.actions.ActionDB
+    :type eppn: str | unicode
+    :type session: str | unicode
+    """
+
+    def __init__(self, actions_db, eppn, session):
+        self.actions_db = actions_db
+        self.eppn = eppn
+        self.session = session
+        self._actions = None
+        self._queue = []
+        self._on_flush = []
+        self._flushed = False
+        self._lock = threading.Lock()
+        # seconds spent in the hook of each plugin, see add_actions
+        self.timings = {}
+
+    @property
+    def actions(self):
+        """
+        The pending actions of the user, for this SSO session or any session.
+
+        :rtype: list of eduid_userdb.actions.Action
+        """
+        with self._lock:
+            if self._actions is None:
+                self._actions = self.actions_db.get_actions(self.eppn, self.session)
+        return self._actions
+
+    def get_actions(self, action_type=None, params=None):
+        """
+        Filter the pending actions of the user.
+
+        :param action_type: only actions of this type
+        :param params: only actions with exactly these params
+
+        :type action_type: str | None
+        :type params: dict | None
+
+        :rtype: list of eduid_userdb.actions.Action
+        """
+        return [this for this in self.actions
+                if (action_type is None or this.action_type == action_type)
+                and (params is None or this.params == params)]
+
+    def has_actions(self, action_type=None, params=None):
+        return bool(self.get_actions(action_type, params))
+
+    def add_action(self, action_type, preference=100, session=None, params=None, unique=False):
+        """
+        Add an action for the user.
+
+        :param action_type: the plugin name
+        :param preference: the actions with higher preference are performed first
+        :param session: SSO session key, to only perform the action in that session
+        :param params: plugin specific parameters
+        :param unique: don't add the action if the user already has one of the same type,
+                       session and params. This is only safe from concurrent logins adding
+                       the same action if there is a unique index on those fields (see e.g.
+                       eduid_action.tou.idp.ensure_tou_action_index).
+
+        :type action_type: str
+        :type preference: int
+        :type session: str | unicode | None
+        :type params: dict | None
+        :type unique: bool
+
+        :return: the action
+        :rtype: eduid_userdb.actions.Action
+        """
+        spec = action_spec(self.eppn, action_type, session=session, params=params or {})
+        # Made in the same way as ActionDB.add_action does
+        action = Action(data=dict(spec, _id=ObjectId(), preference=preference))
+        doc = action.to_dict()
+        if unique:
+            on_insert = {key: value for key, value in doc.items() if key not in spec}
+            request = UpdateOne(spec, {'$setOnInsert': on_insert}, upsert=True)
+        else:
+            request = InsertOne(doc)
+        with self._lock:
+            flushed = self._flushed
+            if not flushed:
+                self._queue.append(request)
+            if self._actions is not None:
+                self._actions.append(action)
+        if flushed:
+            unordered_bulk_write(self.actions_db._coll, [request])
+        return action
+
+    def on_flush(self, callback):
+        """
+        Call `callback' once the queued actions have been written. It is not
+        called if they never are, e.g. because the login failed before the
+        flush or the write failed. If the actions have been flushed already,
+        it is called right away.
+
+        :param callback: function without arguments
+        :type callback: callable
+        """
+        with self._lock:
+            flushed = self._flushed
+            if not flushed:
+                self._on_flush.append(callback)
+        if flushed:
+            callback()
+
+    def flush(self):
+        """
+        Write the queued actions to the database, with a single bulk write,
+        and then call the callbacks registered with `on_flush'.
+
+        :return: number of actions queued
+        :rtype: int
+        """
+        with self._lock:
+            queue, self._queue = self._queue, []
+            callbacks, self._on_flush = self._on_flush, []
+            self._flushed = True
+        if queue:
+            unordered_bulk_write(self.actions_db._coll, queue)
+        for callback in callbacks:
+            callback()
+        return len(queue)
+
+
+def add_actions(idp_app, user, ticket, hooks):
+    """
+    Call the `add_actions' hooks of the given plugins with a shared
+    IdPActionsContext, and write all the actions they add at once.
+
+    The hooks run concurrently, on a thread pool shared by all logins of at
+    most `action_hooks_workers' threads, so that the time it takes is that of
+    the slowest plugin rather than the sum of them all. Each hook has
+    `action_hooks_timeout' seconds to finish (overridden per plugin in
+    `action_hooks_timeouts'), counted from when it starts running. A hook that
+    is still waiting for a pool thread after `action_hooks_queue_timeout'
+    seconds is cancelled and called in the login's own thread instead, so that
+    a busy pool makes logins slower rather than failing them (it is still held
+    to its timeout once it returns). A hook that fails
+    or times out makes the login fail by raising HookFailed, unless the plugin
+    is in `action_hooks_fail_open', in which case it is logged and ignored.
+
+    :param idp_app: IdP application instance
+    :param user: the authenticating user
+    :param ticket: the SSO login data
+    :param hooks: the `add_actions' function of each plugin, by plugin name
+                  (as a dict), or a list of them named after their package
+
+    :type idp_app: eduid_idp.idp.IdPApplication
+    :type user: eduid_idp.idp_user.IdPUser
+    :type ticket: eduid_idp.loginstate.SSOLoginData
+    :type hooks: dict | list of callable
+
+    :raise: HookFailed
+    :return: the context, with the time spent in each hook in `timings'
+    :rtype: IdPActionsContext
+    """
+    if isinstance(hooks, dict):
+        hooks = list(hooks.items())
+    else:
+        hooks = [(_hook_name(hook), hook) for hook in hooks]
+    context = IdPActionsContext(idp_app.actions_db, user.eppn, ticket.key)
+    kwargs = {'context': context}
+    if not idp_app.actions_db:
+        kwargs = {}
+        idp_app.logger.warning('No actions_db - calling the plugins without a context')
+
+    timeout = getattr(idp_app.config, 'action_hooks_timeout', 5)
+    timeouts = getattr(idp_app.config, 'action_hooks_timeouts', None) or {}
+    fail_open = getattr(idp_app.config, 'action_hooks_fail_open', None) or []
+    queue_timeout = getattr(idp_app.config, 'action_hooks_queue_timeout', 1)
+    timings = {}
+    executor = _get_executor(idp_app)
+    submitted = time.monotonic()
+    runs = []
+    for name, hook in hooks:
+        run = _HookRun(name, hook, timings, idp_app, user, ticket, **kwargs)
+        run.future = executor.submit(run)
+        runs.append(run)
+    failed = None
+    for run in runs:
+        name = run.name
+        reason = _wait_for(idp_app, run, timeouts.get(name, timeout), submitted + queue_timeout)
+        if reason is None:
+            continue
+        if name in fail_open:
+            idp_app.logger.warning('Plugin {} add_actions failed ({}), ignoring it'.format(name, reason))
+        else:
+            idp_app.logger.error('Plugin {} add_actions failed ({})'.format(name, reason))
+            failed = failed or HookFailed(name, reason)
+        timings.setdefault(name, time.monotonic() - run.start_time)
+
+    idp_app.logger.debug('Plugin add_actions timings: {}'.format(
+        ', '.join(['{}={:.3f}s'.format(name, timings[name]) for name, _hook in hooks if name in timings])))
+    context.timings = dict(timings)
+    if failed is not None:
+        raise failed
+    if idp_app.actions_db:
+        added = context.flush()
+        idp_app.logger.debug('Added {} action(s) for user {}'.format(added, user))
+    return context
+
+
+def _wait_for(idp_app, run, budget, queue_deadline):
+    """
+    Wait for a hook to finish within its budget, counted from when it started
+    running. If it is still queued at `queue_deadline', it is cancelled and
+    called in this thread instead. It can't be stopped there, but it is still
+    held to its budget once it returns.
+
+    :return: why the hook failed, or None if it didn't
+    :rtype: str | None
+    """
+    try:
+        if not run.started.wait(max(queue_deadline - time.monotonic(), 0)):
+            if run.future.cancel():
+                idp_app.logger.warning('Plugin {} add_actions still queued, calling it directly'.format(run.name))
+                run()
+                if run.timings[run.name] > budget:
+                    return 'timed out'
+                return None
+            # it was picked up by a pool thread just now
+            run.started.wait()
+        run.future.result(timeout=max(run.start_time + budget - time.monotonic(), 0))
+    except TimeoutError:
+        return 'timed out'
+    except Exception as exc:
+        return repr(exc)
+    return None
+
+
+class _HookRun(object):
+    """
+    One call of a plugin's `add_actions' hook, that records when it started
+    running (as opposed to when it was queued) and how long it took.
+    """
+
+    def __init__(self, name, hook, timings, *args, **kwargs):
+        self.name = name
+        self.hook = hook
+        self.timings = timings
+        self.args = args
+        self.kwargs = kwargs
+        self.future = None
+        self.start_time = None
+        self.started = threading.Event()
+
+    def __call__(self):
+        self.start_time = time.monotonic()
+        self.started.set()
+        try:
+            return self.hook(*self.args, **self.kwargs)
+        finally:
+            self.timings[self.name] = time.monotonic() - self.start_time
+
+
+def _hook_name(hook):
+    """
+    The name of the plugin a hook belongs to, e.g. `tou' for eduid_action.tou.idp.add_actions
+    """
+    parts = getattr(hook, '__module__', '').split('.')
+    if len(parts) > 2 and parts[0] == 'eduid_action':
+        return parts[1]
+    return getattr(hook, '__name__', repr(hook))
+
+
+def _get_executor(idp_app):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = getattr(idp_app.config, 'action_hooks_workers', 8)
+            _executor = ThreadPoolExecutor(max_workers=workers)
+    return _executor
@@ -59,8 +59,12 @@ class MockIdPApp:
         error = MagicMock()
 
     class Authn:
+        def __init__(self):
+            # one (user, success, failure) per write to the authn log
+            self.calls = []
+
         def log_authn(self, user, success, failure):
-            pass
+            self.calls.append((user, success, failure))
 
     def __init__(self, actions_db, **kwargs):
         self.config = self.Config(**kwargs)
@@ -69,6 +73,12 @@ class MockIdPApp:
         self.authn = self.Authn()
 
 
+class MockTicket:
+    def __init__(self, key):
+        self.key = key
+        self.mfa_action_creds = {}
+
+
 class TestingActionPlugin(ActionPlugin):
 
     def get_number_of_steps(self):
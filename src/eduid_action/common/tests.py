@@ -0,0 +1,295 @@
+#
+# Copyright (c) 2019 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from mock import MagicMock, patch
+
+from pymongo.errors import BulkWriteError
+
+from eduid_action.common.idp import HookFailed, IdPActionsContext, add_actions
+from eduid_action.common.testing import ActionsTestCase, MockIdPApp, MockTicket
+from eduid_action.mfa import idp as mfa_idp
+from eduid_action.tou import idp as tou_idp
+from eduid_action.common.batch import RateLimiter, chunked, unordered_bulk_write
+from eduid_action.common.cache import LRUCache
+
+
+class LRUCacheTests(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats, {'hits': 2, 'misses': 1, 'evictions': 1, 'size': 2})
+
+    def test_ttl(self):
+        now = [100.0]
+        cache = LRUCache(ttl=10, timer=lambda: now[0])
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        now[0] += 11
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate(self):
+        cache = LRUCache()
+        self.assertEqual(cache.get_or_set('a', lambda: 1), 1)
+        self.assertEqual(cache.get_or_set('a', lambda: 2), 1)
+        cache.invalidate('a')
+        self.assertEqual(cache.get_or_set('a', lambda: 2), 2)
+
+
+class BatchHelperTests(unittest.TestCase):
+
+    def test_chunked(self):
+        self.assertEqual(list(chunked(iter(range(5)), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(chunked([], 2)), [])
+
+    def test_rate_limiter(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        limiter = RateLimiter(rate=10, timer=lambda: now[0], sleep=sleep)
+        limiter.wait(10)
+        limiter.wait(10)
+        limiter.wait(10)
+        self.assertEqual(sleeps, [1.0, 1.0])
+
+
+class UnorderedBulkWriteTests(unittest.TestCase):
+
+    def test_duplicates_ignored(self):
+        coll = MagicMock()
+        coll.bulk_write.side_effect = BulkWriteError({'writeErrors': [{'code': 11000, 'index': 1}],
+                                                      'nInserted': 0, 'nUpserted': 1})
+        self.assertEqual(unordered_bulk_write(coll, ['a', 'b']), 1)
+        coll.bulk_write.assert_called_once_with(['a', 'b'], ordered=False)
+
+    def test_other_errors(self):
+        coll = MagicMock()
+        coll.bulk_write.side_effect = BulkWriteError({'writeErrors': [{'code': 11000, 'index': 0},
+                                                                      {'code': 121, 'index': 1}]})
+        with self.assertRaises(BulkWriteError):
+            unordered_bulk_write(coll, ['a', 'b'])
+
+
+class IdPHooksTests(unittest.TestCase):
+
+    def setUp(self):
+        self.idp_app = MagicMock(actions_db=None)
+        self.idp_app.config = MagicMock(spec=[])
+        self.idp_app.config.action_hooks_timeout = 10
+        self.idp_app.config.action_hooks_timeouts = {'slow': 0.1}
+        self.idp_app.config.action_hooks_fail_open = []
+        self.ticket = MagicMock(key='mock-session')
+        # fake time for the deadlines in add_actions, see _patch_clock
+        self.clock = [0.0]
+
+    def _patch_clock(self):
+        return patch('eduid_action.common.idp.time', MagicMock(monotonic=lambda: self.clock[0]))
+
+    def _blocked_executor(self, release):
+        """
+        A pool with a single thread, busy until `release' is set
+        """
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        self.addCleanup(release.set)
+        executor.submit(release.wait)
+        return executor
+
+    def test_concurrent_hooks(self):
+        called = []
+        # both hooks have to be running at the same time to get past the barrier
+        barrier = threading.Barrier(2, timeout=10)
+
+        def hook(idp_app, user, ticket):
+            barrier.wait()
+            called.append(ticket.key)
+
+        context = add_actions(self.idp_app, MagicMock(), self.ticket, {'a': hook, 'b': hook})
+        self.assertEqual(called, ['mock-session', 'mock-session'])
+        self.assertEqual(sorted(context.timings.keys()), ['a', 'b'])
+
+    def test_timeout_counts_from_start(self):
+        release = threading.Event()
+        executor = self._blocked_executor(release)
+
+        def busy():
+            # the pool thread is busy for 100 seconds, and then takes the hook
+            release.wait()
+            self.clock[0] += 100
+
+        executor.submit(busy)
+        submit = executor.submit
+
+        def submit_and_release(fn):
+            future = submit(fn)
+            release.set()
+            return future
+
+        self.idp_app.config.action_hooks_queue_timeout = 1000
+        with self._patch_clock():
+            with patch('eduid_action.common.idp._get_executor', return_value=executor):
+                with patch.object(executor, 'submit', side_effect=submit_and_release):
+                    # a 10 second budget, although the hook waited 100 seconds in the queue
+                    context = add_actions(self.idp_app, MagicMock(), self.ticket, {'a': lambda *args: None})
+        self.assertEqual(context.timings['a'], 0)
+
+    def test_queued_hook_called_directly(self):
+        threads = []
+
+        def hook(idp_app, user, ticket):
+            threads.append(threading.current_thread())
+
+        self.idp_app.config.action_hooks_queue_timeout = 0
+        release = threading.Event()
+        executor = self._blocked_executor(release)
+        with patch('eduid_action.common.idp._get_executor', return_value=executor):
+            add_actions(self.idp_app, MagicMock(), self.ticket, {'a': hook})
+        self.assertEqual(threads, [threading.current_thread()])
+        # the cancelled future does not call the hook again
+        release.set()
+        executor.shutdown()
+        self.assertEqual(len(threads), 1)
+
+    def test_queued_hook_over_budget(self):
+        def slow(idp_app, user, ticket):
+            self.clock[0] += 1
+
+        self.idp_app.config.action_hooks_queue_timeout = 0
+        executor = self._blocked_executor(threading.Event())
+        with self._patch_clock():
+            with patch('eduid_action.common.idp._get_executor', return_value=executor):
+                with self.assertRaises(HookFailed) as ctx:
+                    add_actions(self.idp_app, MagicMock(), self.ticket, {'slow': slow})
+                self.assertEqual(ctx.exception.reason, 'timed out')
+
+                self.idp_app.config.action_hooks_fail_open = ['slow']
+                context = add_actions(self.idp_app, MagicMock(), self.ticket, {'slow': slow})
+        self.assertEqual(context.timings['slow'], 1)
+
+    def test_fail_closed(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def slow(idp_app, user, ticket):
+            release.wait()
+
+        with self.assertRaises(HookFailed) as ctx:
+            add_actions(self.idp_app, MagicMock(), self.ticket, {'slow': slow})
+        self.assertEqual(ctx.exception.name, 'slow')
+        self.assertEqual(ctx.exception.reason, 'timed out')
+
+    def test_fail_open(self):
+        def broken(idp_app, user, ticket):
+            raise ValueError('broken')
+
+        self.idp_app.config.action_hooks_fail_open = ['broken']
+        context = add_actions(self.idp_app, MagicMock(), self.ticket, {'broken': broken})
+        self.assertIn('broken', context.timings)
+
+
+class IdPActionsContextTests(ActionsTestCase):
+
+    def test_shared_actions_context(self):
+        mock_idp_app = MockIdPApp(self.app.actions_db, tou_version='test-version')
+        hooks = [tou_idp.add_actions, mfa_idp.add_actions]
+        with patch.object(self.app.actions_db, 'get_actions', wraps=self.app.actions_db.get_actions) as mock_get:
+            with patch.object(self.app.actions_db, 'add_action') as mock_add:
+                context = add_actions(mock_idp_app, self.user, MockTicket('mock-session'), hooks)
+                self.assertEqual(mock_get.call_count, 1)
+                self.assertFalse(mock_add.called)
+        self.assertEqual(sorted([this.action_type for this in context.actions]), ['mfa', 'tou'])
+        self.assertTrue(self.app.actions_db.has_actions(self.user.eppn, action_type='tou',
+                                                        params={'version': 'test-version'}))
+        self.assertEqual(len(self.app.actions_db.get_actions(self.user.eppn, 'mock-session', action_type='mfa')), 1)
+        # the existing ToU action is found in the snapshot, and not added again
+        add_actions(mock_idp_app, self.user, MockTicket('other-session'), hooks)
+        self.assertEqual(len(list(self.app.actions_db._coll.find({'action': 'tou'}))), 1)
+
+    def test_unique_actions_concurrent_logins(self):
+        tou_idp.ensure_tou_action_index(self.app.actions_db)
+        first = IdPActionsContext(self.app.actions_db, self.user.eppn, 'first-session')
+        second = IdPActionsContext(self.app.actions_db, self.user.eppn, 'second-session')
+        # both logins find no ToU action in their snapshots
+        self.assertFalse(first.has_actions(action_type='tou'))
+        self.assertFalse(second.has_actions(action_type='tou'))
+        first.add_action('tou', params={'version': 'test-version'}, unique=True)
+        second.add_action('tou', params={'version': 'test-version'}, unique=True)
+        first.flush()
+        second.flush()
+        actions = list(self.app.actions_db._coll.find({'action': 'tou'}))
+        self.assertEqual(len(actions), 1)
+        self.assertEqual(actions[0]['preference'], 100)
+
+
+    def test_on_flush(self):
+        context = IdPActionsContext(self.app.actions_db, self.user.eppn, 'mock-session')
+        called = []
+        context.add_action('tou', params={'version': 'test-version'})
+        context.on_flush(lambda: called.append('queued'))
+        self.assertEqual(called, [])
+        context.flush()
+        self.assertEqual(called, ['queued'])
+        # after the flush, callbacks are called right away
+        context.on_flush(lambda: called.append('late'))
+        self.assertEqual(called, ['queued', 'late'])
+
+    def test_pending_tou_cache_needs_flush(self):
+        def broken(idp_app, user, ticket, context=None):
+            raise ValueError('broken')
+
+        mock_idp_app = MockIdPApp(self.app.actions_db, tou_version='test-version', tou_action_cache_ttl=30)
+        tou_idp.invalidate_pending_tou_action()
+        self.addCleanup(tou_idp.invalidate_pending_tou_action)
+        # the login fails before the queued ToU action is written
+        with self.assertRaises(HookFailed):
+            add_actions(mock_idp_app, self.user, MockTicket('mock-session'),
+                        {'tou': tou_idp.add_actions, 'broken': broken})
+        self.assertFalse(self.app.actions_db.has_actions(self.user.eppn, action_type='tou'))
+        self.assertIsNone(tou_idp._pending_cache.get((self.user.eppn, 'test-version')))
+        # so the next login adds it
+        add_actions(mock_idp_app, self.user, MockTicket('mock-session'), [tou_idp.add_actions])
+        self.assertTrue(self.app.actions_db.has_actions(self.user.eppn, action_type='tou',
+                                                        params={'version': 'test-version'}))
+        self.assertTrue(tou_idp._pending_cache.get((self.user.eppn, 'test-version')))
@@ -38,17 +38,22 @@ from flask import current_app, request
 
 from eduid_common.session import session
 from eduid_action.common.action_abc import ActionPlugin
-from eduid_userdb.credentials import U2F, Webauthn
+from eduid_action.common.cache import LRUCache
 
-from u2flib_server.u2f import begin_authentication, complete_authentication
+try:
+    from u2flib_server.u2f import begin_authentication, complete_authentication
+except ImportError:
+    # Only needed for the legacy U2F code path, see MFA_U2F_VIA_FIDO2
+    begin_authentication = complete_authentication = None
 
-from fido2 import cbor
-from fido2.server import RelyingParty, Fido2Server, U2FFido2Server
 from fido2.client import ClientData
-from fido2.ctap2 import AttestedCredentialData, AuthenticatorData
-from fido2.utils import websafe_decode
+from fido2.ctap2 import AuthenticatorData
 
 from . import RESULT_CREDENTIAL_KEY_NAME
+from .credentials import CredentialIndex, fido_credentials, get_credential, get_user_credentials
+from .options import WebauthnOptionsCache
+from .servers import Fido2ServerRegistry
+from .state import load_state, save_state
 
 
 __author__ = 'ft'
@@ -58,6 +63,10 @@ class Plugin(ActionPlugin):
 
     PACKAGE_NAME = 'eduid_action.mfa'
     steps = 1
+    # U2F and Webauthn credentials are stored in 'passwords'
+    USER_FIELDS = ('passwords',)
+    # get_config_for_bundle only reads, perform_step is followed by writes to the actions db
+    USER_READ_PREFERENCES = {'get_config_for_bundle': 'secondaryPreferred'}
 
     @classmethod
     def includeme(cls, app):
@@ -74,55 +83,74 @@ class Plugin(ActionPlugin):
                 app.logger.error('The "{}" configuration option is required'.format(item))
 
         app.config.setdefault('MFA_TESTING', False)
+        app.config.setdefault('MFA_CREDENTIAL_CACHE_SIZE', 10000)
+        app.config.setdefault('MFA_CREDENTIAL_CACHE_TTL', 3600)
+        # Serve legacy U2F tokens only through fido2 (Webauthn with the appid extension),
+        # without making separate u2flib challenges or accepting u2flib token responses
+        app.config.setdefault('MFA_U2F_VIA_FIDO2', False)
+        if not app.config['MFA_U2F_VIA_FIDO2'] and begin_authentication is None:
+            app.logger.error('python-u2flib-server is required unless MFA_U2F_VIA_FIDO2 is set')
+        # Store the state in the session in the compact format. Only enable this once
+        # no nodes running versions that only read the JSON session keys remain.
+        app.config.setdefault('MFA_COMPACT_SESSION_STATE', False)
+
+        # Decoded FIDO credentials, shared by all requests in this process
+        app.mfa_credential_cache = LRUCache(maxsize=app.config['MFA_CREDENTIAL_CACHE_SIZE'],
+                                            ttl=app.config['MFA_CREDENTIAL_CACHE_TTL'])
+
+        # Encoded Webauthn options, without the challenge
+        app.config.setdefault('MFA_OPTIONS_CACHE_SIZE', 10000)
+        app.config.setdefault('MFA_OPTIONS_CACHE_TTL', 3600)
+        app.webauthn_options_cache = WebauthnOptionsCache(maxsize=app.config['MFA_OPTIONS_CACHE_SIZE'],
+                                                          ttl=app.config['MFA_OPTIONS_CACHE_TTL'])
+
+        # Fido2Server instances, created once and shared by all requests
+        app.fido2_servers = Fido2ServerRegistry('eduID')
+        if app.config.get('FIDO2_RP_ID'):
+            app.fido2_servers.add(app.config['FIDO2_RP_ID'])
+            if app.config.get('U2F_APP_ID'):
+                app.fido2_servers.add(app.config['FIDO2_RP_ID'], app.config['U2F_APP_ID'])
 
     def get_config_for_bundle(self, action):
-        if action.old_format:
-            userid = action.user_id
-            user = current_app.central_userdb.get_user_by_id(
-                userid, raise_on_missing=False)
-        else:
-            eppn = action.eppn
-            user = current_app.central_userdb.get_user_by_eppn(
-                eppn, raise_on_missing=False)
+        user = self.get_user(action, raise_on_missing=False, method='get_config_for_bundle')
+        if not user or not fido_credentials(user):
+            # The user or the credentials might not have been replicated yet, retry on the primary
+            user = self.get_user(action, raise_on_missing=False)
         current_app.logger.debug('Loaded User {} from db'.format(user))
         if not user:
             raise self.ActionError('mfa.user-not-found')
 
+        index = CredentialIndex(user)
         credentials = _get_user_credentials(user)
         current_app.logger.debug('FIDO credentials for user {}:\n{}'.format(user, pprint.pformat(credentials)))
 
-        # CTAP1/U2F
-        # TODO: Only make U2F challenges for U2F tokens?
+        config = {'u2fdata': '{}', 'webauthn_options': ''}
+
         challenge = None
-        if current_app.config.get('GENERATE_U2F_CHALLENGES') is True:
-            u2f_tokens = [v['u2f'] for v in credentials.values()]
-            try:
-                challenge = begin_authentication(current_app.config['U2F_APP_ID'], u2f_tokens)
-                current_app.logger.debug('U2F challenge:\n{}'.format(pprint.pformat(challenge)))
-            except ValueError:
-                # there is no U2F key registered for this user
-                pass
-
-        # CTAP2/Webauthn
-        # TODO: Only make Webauthn challenges for Webauthn tokens?
-        webauthn_credentials = [v['webauthn'] for v in credentials.values()]
-        fido2rp = RelyingParty(current_app.config['FIDO2_RP_ID'], 'eduID')
-        fido2server = _get_fido2server(credentials, fido2rp)
-        raw_fido2data, fido2state = fido2server.authenticate_begin(webauthn_credentials)
-        current_app.logger.debug('FIDO2 authentication data:\n{}'.format(pprint.pformat(raw_fido2data)))
-        fido2data = base64.urlsafe_b64encode(cbor.dumps(raw_fido2data)).decode('ascii')
-        fido2data = fido2data.rstrip('=')
-
-        config = {'u2fdata': '{}', 'webauthn_options': fido2data}
-
-        # Save the challenge to be used when validating the signature in perform_action() below
-        if challenge is not None:
-            session[self.PACKAGE_NAME + '.u2f.challenge'] = challenge.json
+        fido2state = None
+
+        # CTAP1/U2F - only for users with U2F tokens
+        u2f_tokens = [v['u2f'] for v in credentials.values() if v['type'] == 'u2f']
+        if u2f_tokens and current_app.config.get('GENERATE_U2F_CHALLENGES') is True \
+                and not current_app.config['MFA_U2F_VIA_FIDO2']:
+            challenge = begin_authentication(current_app.config['U2F_APP_ID'], u2f_tokens)
+            current_app.logger.debug('U2F challenge:\n{}'.format(pprint.pformat(challenge)))
             config['u2fdata'] = json.dumps(challenge.data_for_client)
             current_app.logger.debug(f'FIDO1/U2F challenge for user {user}: {challenge.data_for_client}')
 
-        current_app.logger.debug(f'FIDO2/Webauthn state for user {user}: {fido2state}')
-        session[self.PACKAGE_NAME + '.webauthn.state'] = json.dumps(fido2state)
+        # CTAP2/Webauthn - for both Webauthn tokens and U2F tokens (through the appid extension)
+        if credentials:
+            fido2server = _get_fido2server(index.app_id)
+            fido2data, fido2state = current_app.webauthn_options_cache.authenticate_begin(
+                fido2server, credentials, index.app_id)
+            current_app.logger.debug('FIDO2 authentication data: {}'.format(fido2data))
+            config['webauthn_options'] = fido2data
+
+            current_app.logger.debug(f'FIDO2/Webauthn state for user {user}: {fido2state}')
+
+        # Save the challenges to be used when validating the signature in perform_action() below
+        save_state(session, webauthn_state=fido2state, u2f_challenge=challenge,
+                   compact=current_app.config['MFA_COMPACT_SESSION_STATE'])
 
         # Explicit check for boolean True
         if current_app.config.get('MFA_TESTING') is True:
@@ -146,12 +174,7 @@ class Plugin(ActionPlugin):
                 'testing': True,
             }
 
-        if action.old_format:
-            userid = action.user_id
-            user = current_app.central_userdb.get_user_by_id(userid, raise_on_missing=False)
-        else:
-            eppn = action.eppn
-            user = current_app.central_userdb.get_user_by_eppn(eppn, raise_on_missing=False)
+        user = self.get_user(action, raise_on_missing=False)
         current_app.logger.debug('Loaded User {} from db (in perform_action)'.format(user))
 
         # Third party service MFA
@@ -174,13 +197,19 @@ class Plugin(ActionPlugin):
             current_app.logger.error('No data in request to authn {}'.format(user))
             raise self.ActionError('mfa.no-request-data')
 
+        index = CredentialIndex(user)
+
         # Process POSTed data
-        if 'tokenResponse' in req_json:
+        if 'tokenResponse' in req_json and current_app.config['MFA_U2F_VIA_FIDO2']:
+            current_app.logger.error('Got a U2F token response from user {}, but U2F is only '
+                                     'supported through Webauthn'.format(user))
+            raise self.ActionError('mfa.no-token-response')
+        elif 'tokenResponse' in req_json:
             # CTAP1/U2F
             token_response = request.get_json().get('tokenResponse', '')
             current_app.logger.debug('U2F token response: {}'.format(token_response))
 
-            challenge = session.get(self.PACKAGE_NAME + '.u2f.challenge')
+            _, challenge = load_state(session)
             current_app.logger.debug('Challenge: {!r}'.format(challenge))
 
             device, counter, touch = complete_authentication(challenge, token_response,
@@ -191,17 +220,18 @@ class Plugin(ActionPlugin):
                 'counter': counter,
             }))
 
-            for this in user.credentials.filter(U2F).to_list():
-                if this.keyhandle == device['keyHandle']:
-                    current_app.logger.info('User {} logged in using U2F token {} (touch: {}, counter {})'.format(
-                        user, this, touch, counter))
-                    action.result = {'success': True,
-                                     'touch': touch,
-                                     'counter': counter,
-                                     RESULT_CREDENTIAL_KEY_NAME: this.key,
-                                     }
-                    current_app.actions_db.update_action(action)
-                    return action.result
+            cred_key = index.find_by_keyhandle(device['keyHandle'])
+            if cred_key is not None:
+                this = index.credentials[cred_key]
+                current_app.logger.info('User {} logged in using U2F token {} (touch: {}, counter {})'.format(
+                    user, this, touch, counter))
+                action.result = {'success': True,
+                                 'touch': touch,
+                                 'counter': counter,
+                                 RESULT_CREDENTIAL_KEY_NAME: this.key,
+                                 }
+                current_app.actions_db.update_action(action)
+                return action.result
         elif 'authenticatorData' in req_json:
             # CTAP2/Webauthn
             req = {}
@@ -214,26 +244,27 @@ class Plugin(ActionPlugin):
                         this, req_json.get(this)))
                     raise self.ActionError('mfa.bad-token-response')  # XXX add bad-token-response to frontend
             current_app.logger.debug('Webauthn request after decoding:\n{}'.format(pprint.pformat(req)))
-            client_data = ClientData(req['clientDataJSON'])
-            auth_data = AuthenticatorData(req['authenticatorData'])
 
-            credentials = _get_user_credentials(user)
-            fido2state = json.loads(session[self.PACKAGE_NAME + '.webauthn.state'])
-
-            rp_id = current_app.config['FIDO2_RP_ID']
-            fido2rp = RelyingParty(rp_id, 'eduID')
-            fido2server = _get_fido2server(credentials, fido2rp)
-            matching_credentials = [(v['webauthn'], k) for k,v in credentials.items()
-                                    if v['webauthn'].credential_id == req['credentialId']]
-
-            if not matching_credentials:
+            # Find the credential using the raw credential id before decoding anything,
+            # and then decode only that one credential
+            cred_key = index.find_by_credential_id(req['credentialId'])
+            if cred_key is None:
                 current_app.logger.error('Could not find webauthn credential {} on user {}'.format(
                     req['credentialId'], user))
                 raise self.ActionError('mfa.unknown-token')
+            credential = get_credential(index.credentials[cred_key], cache=current_app.mfa_credential_cache)
+
+            client_data = ClientData(req['clientDataJSON'])
+            auth_data = AuthenticatorData(req['authenticatorData'])
+            fido2state, _ = load_state(session)
+            if fido2state is None:
+                current_app.logger.error('No Webauthn state in session for user {}'.format(user))
+                raise self.ActionError('mfa.no-webauthn-state')
 
+            fido2server = _get_fido2server(index.app_id)
             authn_cred = fido2server.authenticate_complete(
                 fido2state,
-                [mc[0] for mc in matching_credentials],
+                [credential['webauthn']],
                 req['credentialId'],
                 client_data,
                 auth_data,
@@ -241,8 +272,6 @@ class Plugin(ActionPlugin):
             )
             current_app.logger.debug('Authenticated Webauthn credential: {}'.format(authn_cred))
 
-            cred_key = [mc[1] for mc in matching_credentials][0]
-
             touch = auth_data.flags
             counter = auth_data.counter
             current_app.logger.info('User {} logged in using Webauthn token {} (touch: {}, counter {})'.format(
@@ -266,40 +295,8 @@ class Plugin(ActionPlugin):
 
 
 def _get_user_credentials(user):
-    res = {}
-    for this in user.credentials.filter(U2F).to_list():
-        acd = AttestedCredentialData.from_ctap1(websafe_decode(this.keyhandle),
-                                                websafe_decode(this.public_key))
-        res[this.key] = {'u2f': {'version': this.version,
-                                 'keyHandle': this.keyhandle,
-                                 'publicKey': this.public_key,
-                                 },
-                         'webauthn': acd,
-                         'app_id': this.app_id,
-                         }
-    for this in user.credentials.filter(Webauthn).to_list():
-        keyhandle = this.keyhandle
-        cred_data = base64.urlsafe_b64decode(this.credential_data.encode('ascii'))
-        credential_data, rest = AttestedCredentialData.unpack_from(cred_data)
-        version = 'webauthn'
-        res[this.key] = {'u2f': {'version': version,
-                                 'keyHandle': keyhandle,
-                                 'publicKey': credential_data.public_key,
-                                 },
-                         'webauthn': credential_data,
-                         'app_id': '',
-                         }
-    return res
-
-def _get_fido2server(credentials, fido2rp):
-    # See if any of the credentials is a legacy U2F credential with an app-id
-    # (assume all app-ids are the same - authenticating with a mix of different
-    # app-ids isn't supported in current Webauthn)
-    app_id = None
-    for k, v in credentials.items():
-        if v['app_id']:
-            app_id = v['app_id']
-            break
-    if app_id:
-        return U2FFido2Server(app_id, fido2rp)
-    return Fido2Server(fido2rp)
+    return get_user_credentials(user, cache=current_app.mfa_credential_cache)
+
+
+def _get_fido2server(app_id):
+    return current_app.fido2_servers.get(current_app.config['FIDO2_RP_ID'], app_id)
@@ -0,0 +1,108 @@
+#
+# Copyright (c) 2019 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Benchmark of the Webauthn options cache, comparing the options made with
+authenticate_begin and cbor.dumps on every request with those spliced from
+the cache, for users with different numbers of credentials.
+
+    python -m eduid_action.mfa.benchmark --credentials 1 2 5 --number 10000
+"""
+
+import os
+import sys
+import base64
+import timeit
+import argparse
+
+from fido2 import cbor
+from fido2.ctap2 import AttestedCredentialData
+
+from eduid_action.mfa.options import WebauthnOptionsCache
+from eduid_action.mfa.servers import Fido2ServerRegistry
+
+
+def make_credentials(count):
+    '''
+    :param count: number of credentials
+    :type count: int
+
+    :return: fake decoded credentials, see eduid_action.mfa.credentials.get_user_credentials
+    :rtype: dict
+    '''
+    credentials = {}
+    for i in range(count):
+        credential_id = os.urandom(64)
+        # aaguid, credential id length and id, and a COSE key
+        public_key = {1: 2, 3: -7, -1: 1, -2: os.urandom(32), -3: os.urandom(32)}
+        data = bytes(16) + len(credential_id).to_bytes(2, 'big') + credential_id + cbor.dumps(public_key)
+        cred_data, _ = AttestedCredentialData.unpack_from(data)
+        credentials['key{}'.format(i)] = {'webauthn': cred_data, 'type': 'webauthn'}
+    return credentials
+
+
+def run(credential_counts, number, rp_id='idp.example.com', app_id='https://example.com'):
+    '''
+    :return: microseconds per call without and with the cache, per number of credentials
+    :rtype: dict
+    '''
+    server = Fido2ServerRegistry().get(rp_id, app_id)
+    res = {}
+    for count in credential_counts:
+        credentials = make_credentials(count)
+        webauthn = [v['webauthn'] for v in credentials.values()]
+        cache = WebauthnOptionsCache()
+
+        def uncached():
+            raw_options, state = server.authenticate_begin(webauthn)
+            return base64.urlsafe_b64encode(cbor.dumps(raw_options)).decode('ascii').rstrip('='), state
+
+        def cached():
+            return cache.authenticate_begin(server, credentials, app_id)
+
+        res[count] = tuple([min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6
+                            for func in (uncached, cached)])
+    return res
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Webauthn options cache')
+    parser.add_argument('--credentials', type=int, nargs='+', default=[1, 2, 5])
+    parser.add_argument('--number', type=int, default=10000)
+    opts = parser.parse_args(args)
+    for count, (uncached, cached) in sorted(run(opts.credentials, opts.number).items()):
+        print('{} credential(s): {:.1f} us without cache, {:.1f} us with cache ({:.1f}x)'.format(
+            count, uncached, cached, uncached / cached))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,216 @@
+#
+# Copyright (c) 2019 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import base64
+import struct
+from hashlib import sha256
+
+from eduid_userdb.credentials import U2F, Webauthn
+
+from fido2.ctap2 import AttestedCredentialData
+from fido2.utils import websafe_decode
+
+
+def fido_credentials(user):
+    '''
+    :param user: the user
+    :type user: eduid_userdb.User
+
+    :return: the U2F and Webauthn credentials of the user
+    :rtype: list
+    '''
+    return user.credentials.filter(U2F).to_list() + user.credentials.filter(Webauthn).to_list()
+
+
+def credential_fingerprint(credential):
+    '''
+    Return a digest of the stored data of a U2F or Webauthn credential,
+    so that cached decoded data is never used for a credential whose stored
+    data has changed.
+
+    :param credential: U2F or Webauthn credential
+    :type credential: eduid_userdb.credentials.U2F | eduid_userdb.credentials.Webauthn
+
+    :rtype: str
+    '''
+    if isinstance(credential, Webauthn):
+        parts = [credential.keyhandle, credential.credential_data]
+    else:
+        parts = [credential.version, credential.keyhandle, credential.public_key, credential.app_id]
+    data = '\0'.join([str(this) for this in parts])
+    return sha256(data.encode('utf-8')).hexdigest()
+
+
+def decode_credential(credential):
+    '''
+    Decode the stored data of a U2F or Webauthn credential.
+
+    :param credential: U2F or Webauthn credential
+    :type credential: eduid_userdb.credentials.U2F | eduid_userdb.credentials.Webauthn
+
+    :return: U2F registered key, decoded credential data, app id and credential type
+    :rtype: dict
+    '''
+    if isinstance(credential, Webauthn):
+        cred_data = base64.urlsafe_b64decode(credential.credential_data.encode('ascii'))
+        credential_data, rest = AttestedCredentialData.unpack_from(cred_data)
+        return {'u2f': {'version': 'webauthn',
+                        'keyHandle': credential.keyhandle,
+                        'publicKey': credential_data.public_key,
+                        },
+                'webauthn': credential_data,
+                'app_id': '',
+                'type': 'webauthn',
+                }
+    acd = AttestedCredentialData.from_ctap1(websafe_decode(credential.keyhandle),
+                                            websafe_decode(credential.public_key))
+    return {'u2f': {'version': credential.version,
+                    'keyHandle': credential.keyhandle,
+                    'publicKey': credential.public_key,
+                    },
+            'webauthn': acd,
+            'app_id': credential.app_id,
+            'type': 'u2f',
+            }
+
+
+def get_user_credentials(user, cache=None):
+    '''
+    Return the decoded U2F and Webauthn credentials of a user, keyed by
+    credential key.
+
+    See get_credential for how the cache is used.
+
+    :param user: the user
+    :param cache: decoded credentials cache
+    :type user: eduid_userdb.User
+    :type cache: eduid_action.common.cache.LRUCache | None
+
+    :rtype: dict
+    '''
+    res = {}
+    for this in fido_credentials(user):
+        res[this.key] = get_credential(this, cache=cache)
+    return res
+
+
+def get_credential(credential, cache=None):
+    '''
+    Return a single decoded U2F or Webauthn credential, see decode_credential.
+
+    If a cache is provided, the decoded credential is looked up in (and added to)
+    it using the credential key together with a fingerprint of the stored data.
+    The returned entry may be shared between requests and must not be modified.
+
+    :param credential: U2F or Webauthn credential
+    :param cache: decoded credentials cache
+    :type credential: eduid_userdb.credentials.U2F | eduid_userdb.credentials.Webauthn
+    :type cache: eduid_action.common.cache.LRUCache | None
+
+    :rtype: dict
+    '''
+    if cache is None:
+        return decode_credential(credential)
+    cache_key = (credential.key, credential_fingerprint(credential))
+    return cache.get_or_set(cache_key, lambda: decode_credential(credential))
+
+
+def credential_id(credential):
+    '''
+    Return the raw credential id of a U2F or Webauthn credential, without
+    decoding the public key.
+
+    For U2F credentials this is the key handle, and for Webauthn credentials
+    it is read from the header of the stored attested credential data
+    (16 bytes AAGUID, 2 bytes length, credential id, COSE public key).
+
+    :param credential: U2F or Webauthn credential
+    :type credential: eduid_userdb.credentials.U2F | eduid_userdb.credentials.Webauthn
+
+    :rtype: bytes
+    '''
+    if isinstance(credential, Webauthn):
+        cred_data = base64.urlsafe_b64decode(credential.credential_data.encode('ascii'))
+        length, = struct.unpack('>H', cred_data[16:18])
+        return cred_data[18:18 + length]
+    return websafe_decode(credential.keyhandle)
+
+
+class CredentialIndex(object):
+    '''
+    Index of the U2F and Webauthn credentials of a user, mapping raw credential
+    ids (U2F and Webauthn) and key handles (U2F) to credential keys.
+
+    Building the index does not decode any public keys, so it is cheap enough
+    to create once per request.
+
+    :param user: the user
+    :type user: eduid_userdb.User
+    '''
+
+    __slots__ = ('credentials', 'by_credential_id', 'by_keyhandle', 'app_id')
+
+    def __init__(self, user):
+        self.credentials = {}
+        self.by_credential_id = {}
+        self.by_keyhandle = {}
+        # app-id of legacy U2F credentials (assume all app-ids are the same - authenticating
+        # with a mix of different app-ids isn't supported in current Webauthn)
+        self.app_id = None
+        for this in fido_credentials(user):
+            self.credentials[this.key] = this
+            self.by_credential_id[credential_id(this)] = this.key
+            if isinstance(this, U2F):
+                self.by_keyhandle[this.keyhandle] = this.key
+                if this.app_id and self.app_id is None:
+                    self.app_id = this.app_id
+
+    def __len__(self):
+        return len(self.credentials)
+
+    def find_by_credential_id(self, cred_id):
+        '''
+        :param cred_id: raw credential id
+        :type cred_id: bytes
+
+        :return: the key of the matching credential, or None
+        '''
+        return self.by_credential_id.get(cred_id)
+
+    def find_by_keyhandle(self, keyhandle):
+        '''
+        :param keyhandle: U2F key handle, as stored in the credential
+        :type keyhandle: str
+
+        :return: the key of the matching credential, or None
+        '''
+        return self.by_keyhandle.get(keyhandle)
@@ -33,12 +33,15 @@
 __author__ = 'ft'
 
 import datetime
+from eduid_userdb.actions import Action
 from eduid_userdb.credentials import U2F, Webauthn
 
+from eduid_action.common.idp import action_spec
+
 from . import RESULT_CREDENTIAL_KEY_NAME
 
 
-def add_actions(idp_app, user, ticket):
+def add_actions(idp_app, user, ticket, context=None):
     """
     Add an action requiring the user to login using one or more additional
     authentication factors.
@@ -49,10 +52,12 @@ def add_actions(idp_app, user, ticket):
     :param idp_app: IdP application instance
     :param user: the authenticating user
     :param ticket: the SSO login data
+    :param context: the actions of the user, shared by all plugins
 
     :type idp_app: eduid_idp.idp.IdPApplication
     :type user: eduid_idp.idp_user.IdPUser
     :type ticket: eduid_idp.loginstate.SSOLoginData
+    :type context: eduid_action.common.idp.IdPActionsContext | None
 
     :return: None
     """
@@ -67,18 +72,22 @@ def add_actions(idp_app, user, ticket):
         idp_app.logger.warning('No actions_db - aborting MFA action')
         return None
 
-    existing_actions = idp_app.actions_db.get_actions(user.eppn, ticket.key,
-                                                      action_type = 'mfa',
-                                                      )
-    if existing_actions and len(existing_actions) > 0:
-        idp_app.logger.debug('User has existing MFA actions - checking them')
-        if check_authn_result(idp_app, user, ticket, existing_actions):
-            for this in ticket.mfa_action_creds:
-                idp_app.authn.log_authn(user, success=[this.key], failure=[])
+    completed = None
+    if context is None or _has_completed_action(context, ticket.key):
+        completed = claim_completed_action(idp_app.actions_db, user.eppn, ticket.key)
+    if completed is not None:
+        idp_app.logger.debug('User has a completed MFA action - checking it')
+        if use_authn_result(idp_app, user, ticket, completed):
+            # log all the credentials used in this login with one log_authn call
+            success = [this.key for this in ticket.mfa_action_creds]
+            idp_app.authn.log_authn(user, success=success, failure=[])
             return
         idp_app.logger.error('User returned without MFA credentials')
 
     idp_app.logger.debug('User must authenticate with a token (has {} token(s))'.format(len(tokens)))
+    if context is not None:
+        context.add_action('mfa', preference=1, session=ticket.key, params={})
+        return
     idp_app.actions_db.add_action(
         user.eppn,
         action_type = 'mfa',
@@ -106,16 +115,74 @@ def check_authn_result(idp_app, user, ticket, actions):
     :rtype: bool
     """
     for this in actions:
-        idp_app.logger.debug('Action {} authn result: {}'.format(this, this.result))
-        if this.result.get('success') is True:
-            key = this.result.get(RESULT_CREDENTIAL_KEY_NAME)
-            cred = user.credentials.find(key)
-            if cred:
-                utc_now = datetime.datetime.utcnow().replace(tzinfo = None)  # thanks for not having timezone.utc, Python2
-                ticket.mfa_action_creds[cred] = utc_now
-                idp_app.logger.debug('Removing MFA action completed with {}'.format(cred))
-                idp_app.actions_db.remove_action_by_id(this.action_id)
-                return True
-            else:
-                idp_app.logger.error('MFA action completed with unknown key {}'.format(key))
+        if use_authn_result(idp_app, user, ticket, this):
+            idp_app.logger.debug('Removing completed MFA action {}'.format(this))
+            idp_app.actions_db.remove_action_by_id(this.action_id)
+            return True
+    return False
+
+
+def claim_completed_action(actions_db, eppn, session):
+    """
+    Find a successfully completed MFA action for the user and SSO session, and
+    remove it from the database in the same atomic operation, so that a completed
+    action can only ever be used once, even by concurrent requests.
+
+    :param actions_db: The actions database
+    :param eppn: the eppn of the user
+    :param session: the SSO session key (ticket.key)
+
+    :type actions_db: eduid_userdb.actions.ActionDB
+    :type eppn: str | unicode
+    :type session: str | unicode
+
+    :return: the completed action, or None
+    :rtype: eduid_userdb.actions.Action | None
+    """
+    spec = action_spec(eppn, 'mfa', session=session)
+    spec['result.success'] = True
+    doc = actions_db._coll.find_one_and_delete(spec)
+    if doc is None:
+        return None
+    return Action(data=doc)
+
+
+def _has_completed_action(context, session):
+    """
+    Check the actions already read from the database for a completed MFA action,
+    so that it is only claimed (see claim_completed_action) when there is one.
+    """
+    for this in context.get_actions(action_type='mfa'):
+        if this.session == session and this.result and this.result.get('success') is True:
+            return True
     return False
+
+
+def use_authn_result(idp_app, user, ticket, action):
+    """
+    Record the credential an MFA action was completed with in the SSO login data.
+
+    :param idp_app: IdP application instance
+    :param user: the authenticating user
+    :param ticket: the SSO login data
+    :param action: Action in the ActionDB matching this user and session
+
+    :type idp_app: eduid_idp.idp.IdPApplication
+    :type user: eduid_idp.idp_user.IdPUser
+    :type ticket: eduid_idp.loginstate.SSOLoginData
+    :type action: eduid_userdb.actions.Action
+
+    :return: The action was completed with one of the user's credentials
+    :rtype: bool
+    """
+    idp_app.logger.debug('Action {} authn result: {}'.format(action, action.result))
+    if not action.result or action.result.get('success') is not True:
+        return False
+    key = action.result.get(RESULT_CREDENTIAL_KEY_NAME)
+    cred = user.credentials.find(key)
+    if not cred:
+        idp_app.logger.error('MFA action completed with unknown key {}'.format(key))
+        return False
+    utc_now = datetime.datetime.utcnow().replace(tzinfo = None)  # thanks for not having timezone.utc, Python2
+    ticket.mfa_action_creds[cred] = utc_now
+    return True
@@ -0,0 +1,91 @@
+#
+# Copyright (c) 2019 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import base64
+
+from fido2 import cbor
+
+from eduid_action.common.cache import LRUCache
+
+
+class WebauthnOptionsCache(object):
+    '''
+    Cache of CBOR encoded Webauthn authentication options.
+
+    The options for a user only change when tokens are added or removed,
+    except for the challenge. The encoded options are cached split around
+    the challenge, keyed by the RP ID, the U2F app id and the set of credential
+    keys, so that new options can be made by splicing in a fresh challenge.
+    The result is identical to encoding the output of authenticate_begin.
+
+    :param maxsize: maximum number of cached options
+    :param ttl: seconds cached options are valid, or None for no expiry
+    :type maxsize: int
+    :type ttl: int | None
+    '''
+
+    def __init__(self, maxsize=10000, ttl=None):
+        self.cache = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    def authenticate_begin(self, server, credentials, app_id=None):
+        '''
+        Make Webauthn authentication options for a user.
+
+        :param server: the server to use
+        :param credentials: the user's decoded credentials, see get_user_credentials
+        :param app_id: the U2F app id the server was chosen for
+        :type server: fido2.server.Fido2Server
+        :type credentials: dict
+        :type app_id: str | None
+
+        :return: base64url encoded (unpadded) CBOR options, and the state to
+                 pass to authenticate_complete
+        :rtype: tuple
+        '''
+        key = (server.rp.ident, app_id, frozenset(credentials.keys()))
+        template = self.cache.get(key)
+        if template is not None:
+            prefix, challenge_len, suffix, user_verification = template
+            challenge = os.urandom(challenge_len)
+            encoded = prefix + challenge + suffix
+            state = server._make_internal_state(challenge, user_verification)
+        else:
+            raw_options, state = server.authenticate_begin([v['webauthn'] for v in credentials.values()])
+            encoded = cbor.dumps(raw_options)
+            challenge = raw_options['publicKey']['challenge']
+            # Only cache options where the challenge can be located unambiguously
+            if encoded.count(challenge) == 1:
+                prefix, suffix = encoded.split(challenge)
+                self.cache.set(key, (prefix, len(challenge), suffix, state['user_verification']))
+        options = base64.urlsafe_b64encode(encoded).decode('ascii').rstrip('=')
+        return options, state
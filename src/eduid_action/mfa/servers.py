@@ -0,0 +1,89 @@
+#
+# Copyright (c) 2019 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import threading
+
+from fido2.server import RelyingParty, Fido2Server, U2FFido2Server
+
+
+class Fido2ServerRegistry(object):
+    '''
+    Fido2Server instances keyed by (rp_id, app_id), shared by all requests.
+
+    The servers don't keep any per-request state (that is returned by
+    authenticate_begin and kept in the session), so they can safely be used
+    from several threads at once. Servers for the configured RP ID and U2F app id
+    should be added when the app is initialised, others are created (once) when
+    first asked for.
+
+    :param rp_name: relying party name
+    :type rp_name: str
+    '''
+
+    def __init__(self, rp_name='eduID'):
+        self.rp_name = rp_name
+        self._lock = threading.Lock()
+        self._servers = {}
+
+    def add(self, rp_id, app_id=None):
+        '''
+        Create the server for (rp_id, app_id), unless it already exists.
+
+        :return: the server
+        :rtype: fido2.server.Fido2Server
+        '''
+        key = (rp_id, app_id or None)
+        with self._lock:
+            server = self._servers.get(key)
+            if server is None:
+                rp = RelyingParty(rp_id, self.rp_name)
+                if app_id:
+                    server = U2FFido2Server(app_id, rp)
+                else:
+                    server = Fido2Server(rp)
+                # replace the dict instead of updating it, so that get() never needs the lock
+                servers = dict(self._servers)
+                servers[key] = server
+                self._servers = servers
+            return server
+
+    def get(self, rp_id, app_id=None):
+        '''
+        Return the server to use for credentials registered with `app_id'
+        (legacy U2F credentials), or for Webauthn credentials if app_id is empty.
+
+        :rtype: fido2.server.Fido2Server
+        '''
+        server = self._servers.get((rp_id, app_id or None))
+        if server is None:
+            server = self.add(rp_id, app_id)
+        return server
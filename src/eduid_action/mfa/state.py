@@ -0,0 +1,156 @@
+#
+# Copyright (c) 2019 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Compact encoding of the MFA state kept in the session between
+get_config_for_bundle and perform_step.
+
+The state is CBOR encoded with challenges as raw bytes, prefixed with a
+format version byte, and stored base64url encoded (the session store only
+holds text) under a single session key.
+"""
+
+import json
+
+from fido2 import cbor
+from fido2.utils import websafe_decode, websafe_encode
+
+SESSION_KEY = 'eduid_action.mfa.state'
+
+# Keys used before the compact format was introduced, still read during rollout
+LEGACY_WEBAUTHN_KEY = 'eduid_action.mfa.webauthn.state'
+LEGACY_U2F_KEY = 'eduid_action.mfa.u2f.challenge'
+
+STATE_VERSION = 1
+
+# CBOR map keys
+_WEBAUTHN_CHALLENGE = 1
+_WEBAUTHN_USER_VERIFICATION = 2
+_U2F_CHALLENGE = 3
+_U2F_DATA = 4
+
+
+def pack_state(webauthn_state=None, u2f_challenge=None):
+    '''
+    :param webauthn_state: state returned by Fido2Server.authenticate_begin
+    :param u2f_challenge: U2F challenge returned by u2flib begin_authentication
+    :type webauthn_state: dict | None
+    :type u2f_challenge: dict | None
+
+    :return: the encoded state
+    :rtype: str
+    '''
+    data = {}
+    if webauthn_state is not None:
+        data[_WEBAUTHN_CHALLENGE] = websafe_decode(webauthn_state['challenge'])
+        if webauthn_state.get('user_verification') is not None:
+            data[_WEBAUTHN_USER_VERIFICATION] = webauthn_state['user_verification']
+    if u2f_challenge is not None:
+        u2f_data = dict(u2f_challenge)
+        data[_U2F_CHALLENGE] = websafe_decode(u2f_data.pop('challenge'))
+        data[_U2F_DATA] = u2f_data
+    return websafe_encode(bytes([STATE_VERSION]) + cbor.dumps(data))
+
+
+def unpack_state(packed):
+    '''
+    :param packed: state encoded with pack_state
+    :type packed: str
+
+    :return: Webauthn state and U2F challenge (either can be None)
+    :rtype: tuple
+    '''
+    raw = websafe_decode(packed)
+    if raw[0] != STATE_VERSION:
+        raise ValueError('Unknown MFA state version {}'.format(raw[0]))
+    data, rest = cbor.loads(raw[1:])
+    webauthn_state = None
+    u2f_challenge = None
+    if _WEBAUTHN_CHALLENGE in data:
+        webauthn_state = {'challenge': websafe_encode(data[_WEBAUTHN_CHALLENGE]),
+                          'user_verification': data.get(_WEBAUTHN_USER_VERIFICATION),
+                          }
+    if _U2F_CHALLENGE in data:
+        u2f_challenge = dict(data.get(_U2F_DATA, {}))
+        u2f_challenge['challenge'] = websafe_encode(data[_U2F_CHALLENGE])
+    return webauthn_state, u2f_challenge
+
+
+def save_state(session, webauthn_state=None, u2f_challenge=None, compact=True):
+    '''
+    Store the MFA state in the session, in the compact format or in the legacy
+    JSON keys, and remove the state in the other format so that a stale state
+    is never loaded instead of this one.
+
+    :param session: the session
+    :param webauthn_state: state returned by Fido2Server.authenticate_begin
+    :param u2f_challenge: U2F challenge returned by u2flib begin_authentication
+    :param compact: use the compact format
+    :type compact: bool
+    '''
+    if compact:
+        _discard(session, LEGACY_WEBAUTHN_KEY, LEGACY_U2F_KEY)
+        if webauthn_state is not None or u2f_challenge is not None:
+            session[SESSION_KEY] = pack_state(webauthn_state, u2f_challenge)
+        return
+    _discard(session, SESSION_KEY)
+    if u2f_challenge is not None:
+        session[LEGACY_U2F_KEY] = json.dumps(u2f_challenge)
+    if webauthn_state is not None:
+        session[LEGACY_WEBAUTHN_KEY] = json.dumps(webauthn_state)
+
+
+def _discard(session, *keys):
+    for key in keys:
+        if key in session:
+            del session[key]
+
+
+def load_state(session):
+    '''
+    Load the MFA state from the session. If there is no state in the compact
+    format, the JSON encoded state from the legacy session keys is returned.
+
+    :param session: the session
+
+    :return: Webauthn state and U2F challenge (either can be None)
+    :rtype: tuple
+    '''
+    packed = session.get(SESSION_KEY)
+    if packed:
+        return unpack_state(packed)
+    webauthn_state = None
+    u2f_challenge = None
+    if session.get(LEGACY_WEBAUTHN_KEY):
+        webauthn_state = json.loads(session[LEGACY_WEBAUTHN_KEY])
+    if session.get(LEGACY_U2F_KEY):
+        u2f_challenge = json.loads(session[LEGACY_U2F_KEY])
+    return webauthn_state, u2f_challenge
@@ -34,17 +34,30 @@ from __future__ import absolute_import
 
 import json
 import base64
+import unittest
+from copy import deepcopy
+from datetime import datetime
 from bson import ObjectId
 from mock import patch
-from eduid_userdb.credentials import U2F
+from pymongo.read_preferences import SecondaryPreferred
+from eduid_userdb.credentials import U2F, Webauthn
 from eduid_userdb.testing import MOCKED_USER_STANDARD
-from eduid_action.common.testing import MockIdPApp
+from eduid_userdb.actions import Action
+from eduid_action.common.testing import MockIdPApp, MockTicket
 from eduid_action.common.testing import ActionsTestCase
-from eduid_action.mfa.action import Plugin
-from eduid_action.mfa.idp import add_actions
-from eduid_userdb.exceptions import UserDoesNotExist
+from eduid_action.mfa.action import Plugin, _get_user_credentials
+from eduid_action.mfa.idp import add_actions, claim_completed_action
+from eduid_action.mfa.credentials import CredentialIndex
+from eduid_action.mfa.state import load_state, pack_state, save_state, unpack_state
+from eduid_action.mfa import benchmark
+from eduid_action.mfa.options import WebauthnOptionsCache
+from eduid_action.mfa.servers import Fido2ServerRegistry
+from eduid_userdb.exceptions import UserDoesNotExist, UserIsRevoked
 
-from fido2.server import Fido2Server
+from fido2.server import Fido2Server, U2FFido2Server
+from fido2 import cbor
+from fido2.ctap2 import AttestedCredentialData
+from fido2.utils import websafe_decode, websafe_encode
 
 __author__ = 'ft'
 
@@ -57,10 +70,87 @@ MFA_ACTION = {
         'params': {}
         }
 
-class MockTicket:
-    def __init__(self, key):
-        self.key = key
-        self.mfa_action_creds = {}
+WEBAUTHN_CREDENTIAL_DATA = 'AAAAAAAAAAAAAAAAAAAAAABAV1vXqZcwBJD2RMIH2udd2F7R9NoSNlP7ZSPOtKHzS7n_rHFXcXbSpOoX__aUKyTR6jEC8X' \
+                           'v678WjXC5KEkvziKQBAgMmIVggdVNa6jf8Puu5EF7ZPD6bZq1PYg6b-pBZIOt5ZKG7e3YiWCDWd71z4M9JR3Kb4f63sV' \
+                           'yNXuuPV1JzdZLBo4mkWaQrFA=='
+
+
+class MFAStateTests(unittest.TestCase):
+
+    def test_pack_unpack(self):
+        webauthn_state = Fido2Server._make_internal_state(
+            base64.b64decode('3h/EAZpY25xDdSJCOMx1ABZEA5Odz3yejUI3AUNTQWc='), 'preferred')
+        u2f_challenge = {'appId': 'https://example.com',
+                         'challenge': 'jKnPZbNdr8rVaYt7Fj7wg65TJVmT_tEOtxA1ZXTsCTo',
+                         'registeredKeys': [{'version': 'U2F_V2',
+                                             'keyHandle': 'test_key_handle',
+                                             'publicKey': 'test_public_key'}],
+                         }
+        packed = pack_state(webauthn_state, u2f_challenge)
+        self.assertLess(len(packed), len(json.dumps(webauthn_state)) + len(json.dumps(u2f_challenge)))
+        self.assertEqual(unpack_state(packed), (webauthn_state, u2f_challenge))
+        self.assertEqual(unpack_state(pack_state(webauthn_state)), (webauthn_state, None))
+
+    def test_load_legacy_state(self):
+        webauthn_state = {'challenge': '3h_EAZpY25xDdSJCOMx1ABZEA5Odz3yejUI3AUNTQWc', 'user_verification': 'preferred'}
+        session = {'eduid_action.mfa.webauthn.state': json.dumps(webauthn_state)}
+        self.assertEqual(load_state(session), (webauthn_state, None))
+
+    def test_save_state_formats(self):
+        webauthn_state = {'challenge': '3h_EAZpY25xDdSJCOMx1ABZEA5Odz3yejUI3AUNTQWc', 'user_verification': 'preferred'}
+        session = {}
+        save_state(session, webauthn_state=webauthn_state, compact=True)
+        self.assertEqual(list(session.keys()), ['eduid_action.mfa.state'])
+        # switching back to the legacy format removes the (now stale) compact state
+        fresh_state = {'challenge': 'jKnPZbNdr8rVaYt7Fj7wg65TJVmT_tEOtxA1ZXTsCTo', 'user_verification': 'preferred'}
+        save_state(session, webauthn_state=fresh_state, compact=False)
+        self.assertEqual(list(session.keys()), ['eduid_action.mfa.webauthn.state'])
+        self.assertEqual(load_state(session), (fresh_state, None))
+        save_state(session, webauthn_state=webauthn_state, compact=True)
+        self.assertEqual(list(session.keys()), ['eduid_action.mfa.state'])
+        self.assertEqual(load_state(session), (webauthn_state, None))
+
+
+class WebauthnOptionsCacheTests(unittest.TestCase):
+
+    def test_options_cache(self):
+        cred_data, _ = AttestedCredentialData.unpack_from(base64.urlsafe_b64decode(WEBAUTHN_CREDENTIAL_DATA))
+        credentials = {'test-key': {'webauthn': cred_data}}
+        server = Fido2ServerRegistry().get('idp.example.com', 'https://example.com')
+        cache = WebauthnOptionsCache()
+        first, first_state = cache.authenticate_begin(server, credentials, 'https://example.com')
+        second, second_state = cache.authenticate_begin(server, credentials, 'https://example.com')
+        self.assertEqual(cache.cache.stats['hits'], 1)
+        self.assertNotEqual(first_state['challenge'], second_state['challenge'])
+
+        first_options, _ = cbor.loads(websafe_decode(first))
+        second_options, _ = cbor.loads(websafe_decode(second))
+        self.assertEqual(websafe_encode(second_options['publicKey'].pop('challenge')), second_state['challenge'])
+        first_options['publicKey'].pop('challenge')
+        self.assertEqual(first_options, second_options)
+
+    def test_options_cache_identical_output(self):
+        cred_data, _ = AttestedCredentialData.unpack_from(base64.urlsafe_b64decode(WEBAUTHN_CREDENTIAL_DATA))
+        credentials = {'test-key': {'webauthn': cred_data}}
+        server = Fido2ServerRegistry().get('idp.example.com', 'https://example.com')
+        cache = WebauthnOptionsCache()
+        cache.authenticate_begin(server, credentials, 'https://example.com')
+        challenge = b'\x01' * 32
+        with patch('os.urandom', return_value=challenge):
+            options, state = cache.authenticate_begin(server, credentials, 'https://example.com')
+            self.assertEqual(cache.cache.stats['hits'], 1)
+            raw_options, expected_state = server.authenticate_begin([cred_data])
+        # the spliced options are byte for byte what fido2 would have encoded
+        self.assertEqual(websafe_decode(options), cbor.dumps(raw_options))
+        self.assertEqual(options, websafe_encode(cbor.dumps(raw_options)))
+        # and the state (made with the private Fido2Server._make_internal_state) is what
+        # authenticate_begin returns, in the format authenticate_complete expects
+        self.assertEqual(state, expected_state)
+        self.assertEqual(state, {'challenge': websafe_encode(challenge), 'user_verification': 'preferred'})
+
+    def test_options_cache_benchmark(self):
+        res = benchmark.run([1, 2], number=10)
+        self.assertEqual(sorted(res.keys()), [1, 2])
 
 
 class MFAActionPluginTests(ActionsTestCase):
@@ -165,6 +255,35 @@ class MFAActionPluginTests(ActionsTestCase):
                     self.assertEquals(u2f_data["appId"], "https://example.com")
                     self.assertEquals(len(self.app.actions_db.get_actions(self.user.eppn, 'mock-session')), 1)
 
+    def test_get_config_webauthn_only(self):
+        for token in self.user.credentials.filter(U2F).to_list():
+            self.user.credentials.remove(token.key)
+        webauthn = Webauthn(keyhandle='test_webauthn_key_handle',
+                            credential_data=WEBAUTHN_CREDENTIAL_DATA,
+                            app_id='idp.example.com',
+                            attest_obj='',
+                            description='unit test Webauthn token',
+                            )
+        self.user.credentials.add(webauthn)
+        self.app.central_userdb.save(self.user, check_sync=False)
+        with self.session_cookie(self.browser) as client:
+            with client.session_transaction() as sess:
+                with self.app.test_request_context():
+                    self.app.config['GENERATE_U2F_CHALLENGES'] = True
+                    mock_idp_app = MockIdPApp(self.app.actions_db)
+                    add_actions(mock_idp_app, self.user, MockTicket('mock-session'))
+                    self.authenticate(client, sess, idp_session='mock-session')
+                    response = client.get('/get-actions')
+                    self.assertEqual(response.status_code, 200)
+                    response = client.get('/config')
+                    data = json.loads(response.data.decode('utf-8'))
+                    self.assertEquals(data['payload']['u2fdata'], '{}')
+                    self.assertNotEquals(data['payload']['webauthn_options'], '')
+            with client.session_transaction() as sess:
+                webauthn_state, u2f_challenge = load_state(sess)
+                self.assertIsNotNone(webauthn_state)
+                self.assertIsNone(u2f_challenge)
+
     def test_get_config_no_user(self):
         self.app.central_userdb.remove_user_by_id(self.user.user_id)
         with self.session_cookie(self.browser) as client:
@@ -205,6 +324,22 @@ class MFAActionPluginTests(ActionsTestCase):
                 self.assertEquals(data['payload']['message'], "mfa.unknown-token")
                 self.assertEquals(len(self.app.actions_db.get_actions(self.user.eppn, 'mock-session')), 1)
 
+    @patch('eduid_action.mfa.action.complete_authentication')
+    def test_action_u2f_via_fido2(self, mock_complete_authn):
+        self.app.config['MFA_U2F_VIA_FIDO2'] = True
+        with self.session_cookie(self.browser) as client:
+            self.prepare(client, Plugin, 'mfa', action_dict=MFA_ACTION)
+            with self.app.test_request_context():
+                with client.session_transaction() as sess:
+                    csrf_token = sess.get_csrf_token()
+                data = json.dumps({'csrf_token': csrf_token,
+                                   'tokenResponse': 'dummy-response'})
+                response = client.post('/post-action', data=data, content_type=self.content_type_json)
+                self.assertEquals(response.status_code, 200)
+                data = json.loads(response.data)
+                self.assertEquals(data['payload']['message'], "mfa.no-token-response")
+                self.assertFalse(mock_complete_authn.called)
+
     @patch('eduid_action.mfa.action.complete_authentication')
     def test_action_success(self, mock_complete_authn):
         mock_complete_authn.return_value = ({'keyHandle': 'test_key_handle'}, 'dummy-touch', 'dummy-counter')
@@ -284,6 +419,47 @@ class MFAActionPluginTests(ActionsTestCase):
                 add_actions(mock_idp_app, self.user, MockTicket('mock-session'))
                 self.assertEquals(len(self.app.actions_db.get_actions(self.user.eppn, 'mock-session')), 0)
 
+    def test_claim_completed_action(self):
+        cred = self.user.credentials.filter(U2F).to_list()[0]
+        action = deepcopy(MFA_ACTION)
+        action['result'] = {'success': True, 'cred_key': cred.key}
+        self.app.actions_db._coll.insert_one(action)
+        mock_idp_app = MockIdPApp(self.app.actions_db)
+        ticket = MockTicket('mock-session')
+        add_actions(mock_idp_app, self.user, ticket)
+        self.assertEqual(list(ticket.mfa_action_creds.keys()), [cred])
+        self.assertEqual(mock_idp_app.authn.calls, [(self.user, [cred.key], [])])
+        self.assertEquals(len(self.app.actions_db.get_actions(self.user.eppn, 'mock-session')), 0)
+        # a completed action can only be used once
+        self.assertIsNone(claim_completed_action(self.app.actions_db, self.user.eppn, 'mock-session'))
+
+    def test_claim_completed_action_logs_all_creds(self):
+        webauthn = Webauthn(keyhandle='test_webauthn_key_handle',
+                            credential_data=WEBAUTHN_CREDENTIAL_DATA,
+                            app_id='idp.example.com',
+                            attest_obj='',
+                            description='unit test Webauthn token',
+                            )
+        self.user.credentials.add(webauthn)
+        cred = self.user.credentials.filter(U2F).to_list()[0]
+        action = deepcopy(MFA_ACTION)
+        action['result'] = {'success': True, 'cred_key': cred.key}
+        self.app.actions_db._coll.insert_one(action)
+        mock_idp_app = MockIdPApp(self.app.actions_db)
+        ticket = MockTicket('mock-session')
+        # a credential already used earlier in this login
+        ticket.mfa_action_creds[webauthn] = datetime.utcnow()
+        add_actions(mock_idp_app, self.user, ticket)
+        self.assertEqual(len(mock_idp_app.authn.calls), 1)
+        user, success, failure = mock_idp_app.authn.calls[0]
+        self.assertEqual(sorted(success), sorted([webauthn.key, cred.key]))
+        self.assertEqual(failure, [])
+
+    def test_claim_completed_action_not_completed(self):
+        self.app.actions_db._coll.insert_one(deepcopy(MFA_ACTION))
+        self.assertIsNone(claim_completed_action(self.app.actions_db, self.user.eppn, 'mock-session'))
+        self.assertEquals(len(self.app.actions_db.get_actions(self.user.eppn, 'mock-session')), 1)
+
     def test_third_party_mfa_action_success(self):
         with self.session_cookie(self.browser) as client:
             self.prepare(client, Plugin, 'mfa', action_dict=MFA_ACTION)
@@ -309,3 +485,123 @@ class MFAActionPluginTests(ActionsTestCase):
             self.assertEquals(response.status_code, 302)
             db_actions = self.app.actions_db.get_actions(self.user.eppn, 'mock-session')
             self.assertIsNone(db_actions[0].result)
+
+    def test_credential_cache(self):
+        with self.app.test_request_context():
+            cache = self.app.mfa_credential_cache
+            cache.clear()
+            first = _get_user_credentials(self.user)
+            second = _get_user_credentials(self.user)
+            self.assertEqual(list(first.keys()), list(second.keys()))
+            for key in first:
+                self.assertIs(first[key]['webauthn'], second[key]['webauthn'])
+            self.assertEqual(cache.stats['misses'], 1)
+            self.assertEqual(cache.stats['hits'], 1)
+
+            # changed stored data must not be served from the cache
+            u2f = self.user.credentials.filter(U2F).to_list()[0]
+            u2f.public_key = 'other_public_key'
+            _get_user_credentials(self.user)
+            self.assertEqual(cache.stats['misses'], 2)
+
+    def test_fido2_server_registry(self):
+        servers = self.app.fido2_servers
+        server = servers.get('idp.example.com')
+        self.assertIs(type(server), Fido2Server)
+        self.assertIs(servers.get('idp.example.com', ''), server)
+        u2f_server = servers.get('idp.example.com', 'https://example.com')
+        self.assertIsInstance(u2f_server, U2FFido2Server)
+        self.assertIs(servers.get('idp.example.com', 'https://example.com'), u2f_server)
+
+    def test_credential_index(self):
+        u2f = self.user.credentials.filter(U2F).to_list()[0]
+        index = CredentialIndex(self.user)
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.find_by_keyhandle('test_key_handle'), u2f.key)
+        self.assertEqual(index.find_by_credential_id(websafe_decode('test_key_handle')), u2f.key)
+        self.assertIsNone(index.find_by_keyhandle('wrong-handle'))
+        self.assertEqual(index.app_id, 'https://dev.eduid.se/u2f-app-id.json')
+
+    @patch('eduid_action.mfa.credentials.decode_credential')
+    def test_action_webauthn_unknown_credential(self, mock_decode):
+        with self.session_cookie(self.browser) as client:
+            self.prepare(client, Plugin, 'mfa', action_dict=MFA_ACTION)
+            with self.app.test_request_context():
+                with client.session_transaction() as sess:
+                    csrf_token = sess.get_csrf_token()
+                data = json.dumps({'csrf_token': csrf_token,
+                                   'authenticatorData': 'mZ9k6EPHoJxJZNA+UuvM0JVoutZHmqelg9kXe/DSefgBAAAA/w==',
+                                   'clientDataJSON': 'eyJ0eXBlIjoid2ViYXV0aG4uZ2V0In0=',
+                                   'credentialId': 'dW5rbm93bi1jcmVkZW50aWFs',
+                                   'signature': 'MEYCIQC5gM8inamJGUFKu3bNo4fT0jmJQuw33OSSXc242NCuiw=='}
+                                  )
+                response = client.post('/post-action', data=data, content_type=self.content_type_json)
+                self.assertEquals(response.status_code, 200)
+                data = json.loads(response.data)
+                self.assertEquals(data['payload']['message'], "mfa.unknown-token")
+                # the credentials of the user should not have been decoded
+                self.assertFalse(mock_decode.called)
+                self.assertEquals(len(self.app.actions_db.get_actions(self.user.eppn, 'mock-session')), 1)
+
+    def test_get_user_projection_revoked(self):
+        self.app.central_userdb._coll.update_one({'_id': self.user.user_id},
+                                                 {'$set': {'revoked_ts': datetime.utcnow()}})
+        action = Action(data=deepcopy(MFA_ACTION))
+        with self.app.test_request_context():
+            # the fields checked by the User constructor are loaded with the projection too
+            with self.assertRaises(UserIsRevoked):
+                Plugin().get_user(action)
+            with self.assertRaises(UserIsRevoked):
+                Plugin().get_user(action, method='get_config_for_bundle')
+
+    def test_get_user_projection(self):
+        action = Action(data=deepcopy(MFA_ACTION))
+        with self.app.test_request_context():
+            plugin = Plugin()
+            user = plugin.get_user(action)
+            self.assertEqual(user.eppn, self.user.eppn)
+            self.assertEqual(len(user.credentials.filter(U2F).to_list()), 1)
+            # only the fields declared by the plugin are loaded
+            self.assertEqual(user.mail_addresses.to_list(), [])
+            # and the user is only loaded once per request
+            self.assertIs(plugin.get_user(action), user)
+            self.assertIs(Plugin().get_user(action), user)
+            # read-only steps may read from a secondary
+            user = plugin.get_user(action, method='get_config_for_bundle')
+            self.assertEqual(user.eppn, self.user.eppn)
+
+    def test_get_user_read_preference(self):
+        action = Action(data=deepcopy(MFA_ACTION))
+        coll = self.app.central_userdb._coll
+        with self.app.test_request_context():
+            self.app.config['USER_READ_MAX_STALENESS'] = 120
+            with patch.object(coll, 'with_options', wraps=coll.with_options) as mock_with_options:
+                Plugin().get_user(action)
+                self.assertFalse(mock_with_options.called)
+                Plugin().get_user(action, method='get_config_for_bundle')
+                mock_with_options.assert_called_once_with(read_preference=SecondaryPreferred(max_staleness=120))
+
+    def test_get_config_primary_fallback(self):
+        read_preferences = []
+        load_user = Plugin._load_user
+
+        def secondary_miss(plugin, spec, fields, read_preference='primary'):
+            read_preferences.append(read_preference)
+            if read_preference != 'primary':
+                # not replicated to the secondary yet
+                return None
+            return load_user(plugin, spec, fields, read_preference)
+
+        with patch.object(Plugin, '_load_user', autospec=True, side_effect=secondary_miss):
+            with self.session_cookie(self.browser) as client:
+                with client.session_transaction() as sess:
+                    with self.app.test_request_context():
+                        mock_idp_app = MockIdPApp(self.app.actions_db)
+                        add_actions(mock_idp_app, self.user, MockTicket('mock-session'))
+                        self.authenticate(client, sess, idp_session='mock-session')
+                        response = client.get('/get-actions')
+                        self.assertEqual(response.status_code, 200)
+                        response = client.get('/config')
+                        data = json.loads(response.data.decode('utf-8'))
+                        self.assertNotEqual(data['payload']['webauthn_options'], '')
+        self.assertEqual(read_preferences[-2:], ['secondaryPreferred', 'primary'])
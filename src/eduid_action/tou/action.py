@@ -37,15 +37,22 @@ from datetime import datetime
 
 from flask import current_app, request
 
+from eduid_common.session import session
 from eduid_action.common.action_abc import ActionPlugin
+from eduid_action.common.cache import LRUCache
 from eduid_userdb.tou import ToUEvent
-from eduid_userdb.actions.tou import ToUUserDB, ToUUser
+from eduid_userdb.actions.tou import ToUUser
+from eduid_action.tou.db import ToUUserDB
+
+
+PENDING_SYNC_SESSION_KEY = 'eduid_action.tou.pending_sync'
 
 
 class Plugin(ActionPlugin):
 
     PACKAGE_NAME = 'eduid_action.tou'
     steps = 1
+    USER_FIELDS = ('tou',)
 
     def __init__(self):
         super(Plugin, self).__init__()
@@ -57,49 +64,252 @@ class Plugin(ActionPlugin):
     @classmethod
     def includeme(cls, app):
         app.tou_db = ToUUserDB(app.config.get('MONGO_URI'))
+        # Only send the ToU text in the negotiated language
+        app.config.setdefault('TOU_NEGOTIATE_LANGUAGE', False)
+        # Bundle config (ToU texts) per version and language, see invalidate_tou_cache
+        app.config.setdefault('TOU_CACHE_SIZE', 100)
+        app.config.setdefault('TOU_CACHE_TTL', 300)
+        app.tou_cache = LRUCache(maxsize=app.config['TOU_CACHE_SIZE'], ttl=app.config['TOU_CACHE_TTL'])
+        # Don't wait for the Attribute Manager sync when the user accepts, let the
+        # client poll for the result in a second step instead
+        app.config.setdefault('TOU_ASYNC_SYNC', False)
+        # Seconds to wait for the Attribute Manager sync when not syncing asynchronously
+        app.config.setdefault('TOU_AM_SYNC_TIMEOUT', 10)
+        # Write only the new ToU event to the ToU db, with an atomic $push, instead of
+        # saving the whole user. Requires the ToU AM plugin to have access to the central
+        # userdb, so that it only pushes the new events (see eduid_action.tou.am).
+        app.config.setdefault('TOU_PARTIAL_UPDATES', False)
+
+    def get_number_of_steps(self):
+        if current_app.config.get('TOU_ASYNC_SYNC') is True:
+            # Accept, and then poll for the result of the sync. While the sync is
+            # running, _check_sync keeps the client on the poll step by going back
+            # one step in session['current_step']. This depends on the actions app
+            # checking if the action is finished, and otherwise moving on to the next
+            # step, only after perform_step returns (as it also goes back one step
+            # itself on a ValidationError).
+            return 2
+        return self.steps
 
     def get_config_for_bundle(self, action):
-        tous = current_app.get_tous(version=action.params['version'])
-        if not tous:
-            current_app.logger.error('Could not load any TOUs')
-            raise self.ActionError('tou.no-tou')
-        return {
-            'version': action.params['version'],
-            'tous': tous,
-            'available_languages': current_app.config.get('AVAILABLE_LANGUAGES')
-        }
+        status = None
+        pending = _get_pending_sync(action)
+        if pending is not None:
+            # A sync requested in an earlier visit, whose result the client never polled for
+            status = self._resolve_sync(action, pending)
+        version = action.params['version']
+        config = self._get_config(version)
+        if current_app.config.get('TOU_NEGOTIATE_LANGUAGE') is True:
+            # Only send the ToU text in the user's language. Other languages can be
+            # fetched with a `lang' query parameter.
+            language = _negotiate_language(list(config['tous'].keys()))
+            config = current_app.tou_cache.get_or_set((version, language),
+                                                      lambda: _language_config(config, language))
+        config = dict(config)
+        if status == 'done':
+            # The ToU has been accepted and synced already, and the action removed,
+            # so the client can move on to the next action (/redirect-action)
+            # without asking the user again
+            config['completed'] = True
+        elif status == 'pending':
+            # The client should poll for the result instead of asking the user again
+            config['pending'] = True
+        return config
+
+    def _get_config(self, version):
+        config = current_app.tou_cache.get((version, None))
+        if config is None:
+            tous = current_app.get_tous(version=version)
+            if not tous:
+                current_app.logger.error('Could not load any TOUs')
+                raise self.ActionError('tou.no-tou')
+            config = {
+                'version': version,
+                'tous': tous,
+                'available_languages': current_app.config.get('AVAILABLE_LANGUAGES')
+            }
+            current_app.tou_cache.set((version, None), config)
+        return config
 
     def perform_step(self, action):
+        pending = _get_pending_sync(action)
+        if pending is not None:
+            return self._check_sync(action, pending)
+
         if not request.get_json().get('accept', ''):
             raise self.ActionError('tou.must-accept')
-        if action.old_format:
-            userid = action.user_id
-            central_user = current_app.central_userdb.get_user_by_id(userid)
-        else:
-            eppn = action.eppn
-            central_user = current_app.central_userdb.get_user_by_eppn(eppn)
+        central_user = self.get_user(action)
         version = action.params['version']
-        user = ToUUser.from_user(central_user, current_app.tou_db)
-        current_app.logger.debug('Loaded ToUUser {} from db'.format(user))
-        current_app.logger.info('ToU version {} accepted by user {}'.format(version, user))
         event_id = ObjectId()
-        user.tou.add(ToUEvent(
+        event = ToUEvent(
             version = version,
             application = 'eduid_tou_plugin',
             created_ts = datetime.utcnow(),
             event_id = event_id
-            ))
-        current_app.tou_db.save(user, check_sync=False)
+            )
+        if current_app.config.get('TOU_PARTIAL_UPDATES') is True:
+            user = central_user
+            current_app.logger.info('ToU version {} accepted by user {}'.format(version, user))
+            current_app.tou_db.add_tou_event(user, event)
+        else:
+            user = ToUUser.from_user(central_user, current_app.tou_db)
+            current_app.logger.debug('Loaded ToUUser {} from db'.format(user))
+            current_app.logger.info('ToU version {} accepted by user {}'.format(version, user))
+            user.tou.add(event)
+            current_app.tou_db.save(user, check_sync=False)
         current_app.logger.debug("Asking for sync of {} by Attribute Manager".format(user))
-        rtask = self._update_attributes.delay('tou', str(user.user_id))
+        if current_app.config.get('TOU_ASYNC_SYNC') is True:
+            rtask = self._update_attributes.delay('tou', str(user.user_id))
+            pending = {
+                'action_id': str(action.action_id),
+                'task_id': rtask.id,
+                'user_id': str(user.user_id),
+                'event_id': str(event_id),
+            }
+            session[PENDING_SYNC_SESSION_KEY] = pending
+            # Also kept with the action, to compensate a failed sync the next time the
+            # action is started, if the client never comes back to poll for the result
+            action.result = {'pending_sync': pending}
+            current_app.actions_db.update_action(action)
+            return {'pending': True}
         try:
-            result = rtask.get(timeout=10)
+            timeout = current_app.config.get('TOU_AM_SYNC_TIMEOUT', 10)
+            rtask = self._update_attributes.delay('tou', str(user.user_id))
+            result = rtask.get(timeout=timeout)
             current_app.logger.debug("Attribute Manager sync result: {!r}".format(result))
             current_app.actions_db.remove_action_by_id(action.action_id)
             current_app.logger.info('Removed completed action {}'.format(action))
             return {}
         except Exception as e:
             current_app.logger.error("Failed Attribute Manager sync request: " + str(e))
-            user.tou.remove(event_id)
-            current_app.tou_db.save(user)
+            _remove_tou_event(user.user_id, event_id)
             raise self.ActionError('tou.sync-problem')
+
+    def _check_sync(self, action, pending):
+        '''
+        Check, without blocking, the result of an Attribute Manager sync
+        requested when the user accepted the ToU.
+
+        While the sync is running, the client is kept on this step and gets a
+        pending status, so it can poll again.
+
+        :param action: the action as retrieved from the eduid_actions db
+        :param pending: data about the sync, see _get_pending_sync
+        :type action: eduid_userdb.actions.Action
+        :type pending: dict
+
+        :raise: ActionPlugin.ActionError if the sync failed
+        :return: dict
+        '''
+        status = self._resolve_sync(action, pending)
+        if status == 'pending':
+            # Stay on this step, see get_number_of_steps
+            session['current_step'] -= 1
+            return {'pending': True}
+        if status == 'failed':
+            raise self.ActionError('tou.sync-problem')
+        return {}
+
+    def _resolve_sync(self, action, pending):
+        '''
+        Find out, without blocking, how an Attribute Manager sync ended. A
+        finished action is removed, and a failed sync is compensated by
+        removing the acceptance from the ToU db again.
+
+        :param action: the action as retrieved from the eduid_actions db
+        :param pending: data about the sync, see _get_pending_sync
+        :type action: eduid_userdb.actions.Action
+        :type pending: dict
+
+        :return: 'pending', 'done' or 'failed'
+        :rtype: str
+        '''
+        result = self._update_attributes.AsyncResult(pending['task_id'])
+        if not result.ready():
+            current_app.logger.debug('Attribute Manager sync {} not finished yet'.format(pending['task_id']))
+            return 'pending'
+        if PENDING_SYNC_SESSION_KEY in session:
+            del session[PENDING_SYNC_SESSION_KEY]
+        if result.successful():
+            current_app.logger.debug("Attribute Manager sync result: {!r}".format(result.result))
+            current_app.actions_db.remove_action_by_id(action.action_id)
+            current_app.logger.info('Removed completed action {}'.format(action))
+            return 'done'
+        current_app.logger.error("Failed Attribute Manager sync request: {!s}".format(result.result))
+        _remove_tou_event(ObjectId(pending['user_id']), ObjectId(pending['event_id']))
+        action.result = None
+        current_app.actions_db.update_action(action)
+        return 'failed'
+
+
+def _get_pending_sync(action):
+    '''
+    The Attribute Manager sync requested when the user accepted the ToU
+    for this action, if its result hasn't been checked yet.
+
+    :param action: the action as retrieved from the eduid_actions db
+    :type action: eduid_userdb.actions.Action
+
+    :return: the action id, celery task id, user id and ToU event id, or None
+    :rtype: dict | None
+    '''
+    pending = session.get(PENDING_SYNC_SESSION_KEY)
+    if pending is not None and pending.get('action_id') == str(action.action_id):
+        return pending
+    if action.result:
+        return action.result.get('pending_sync')
+    return None
+
+
+def _remove_tou_event(user_id, event_id):
+    '''
+    Undo the acceptance of the ToU in the ToU db, after a failed sync.
+    '''
+    if current_app.config.get('TOU_PARTIAL_UPDATES') is True:
+        current_app.tou_db.remove_tou_event(user_id, event_id)
+        return
+    user = current_app.tou_db.get_user_by_id(user_id, raise_on_missing=False)
+    if user is not None:
+        user.tou.remove(event_id)
+        current_app.tou_db.save(user)
+
+
+def invalidate_tou_cache(version=None):
+    """
+    Remove the cached bundle config for a ToU version, or for all versions,
+    e.g. after the texts have been updated.
+
+    :param version: ToU version, or None for all versions
+    :type version: str | None
+    """
+    if version is None:
+        current_app.tou_cache.clear()
+    else:
+        current_app.tou_cache.invalidate_matching(lambda key: key[0] == version)
+
+
+def _negotiate_language(languages):
+    """
+    Choose the language to send the ToU in, from (in order) the `lang' query
+    parameter, the language in the session, and the Accept-Language header.
+
+    :param languages: the languages the ToU is available in
+    :type languages: list
+
+    :rtype: str
+    """
+    for language in [request.args.get('lang'), session.get('language')]:
+        if language in languages:
+            return language
+    language = request.accept_languages.best_match(languages)
+    if language is None:
+        default = current_app.config.get('DEFAULT_LANGUAGE', 'en')
+        language = default if default in languages else sorted(languages)[0]
+    return language
+
+
+def _language_config(config, language):
+    res = dict(config)
+    res['tous'] = {language: config['tous'][language]}
+    res['language'] = language
+    return res
@@ -33,8 +33,9 @@
 __author__ = 'eperez'
 
 import pymongo.errors
+from eduid_userdb import UserDB
 from eduid_userdb.exceptions import UserDoesNotExist
-from eduid_userdb.actions.tou import ToUUserDB
+from eduid_userdb.actions.tou import ToUUserDB, ToUUser
 
 import logging
 logger = logging.getLogger(__name__)
@@ -47,8 +48,11 @@ class ToUAMPContext(object):
 
     def __init__(self, db_uri):
         self.tou_userdb = None
+        # The central userdb, to find out which ToU events are already there
+        self.userdb = None
         if db_uri is not None:
             self.tou_userdb = ToUUserDB(db_uri)
+            self.userdb = UserDB(db_uri)
 
 
 def plugin_init(am_conf):
@@ -86,13 +90,7 @@ def attribute_fetcher(context, user_id):
     if user is None:
         raise UserDoesNotExist("No user matching _id='%s'" % user_id)
 
-    tous = user.tou.to_list_of_dicts()
-
-    import pprint
-    logger.debug("Processing user {}:\nToUs: {!r}".format(user,
-        pprint.pformat(tous)))
-
-    attributes = {'$set': {'tou': tous}}
+    attributes = _build_update(user, _get_central_event_ids(context, [user_id]).get(user_id))
 
     try:
         context.tou_userdb.remove_user_by_id(user_id)
@@ -103,3 +101,114 @@ def attribute_fetcher(context, user_id):
         pass
 
     return attributes
+
+
+def attribute_fetcher_bulk(context, user_ids, raise_on_missing=False):
+    """
+    Bulk version of attribute_fetcher, reading many users from the ToU private
+    userdb with a single query and removing them with a single delete. A user
+    is only removed if it still has the events that were read, so that an event
+    added in between (e.g. by a new acceptance) is kept for its own sync.
+
+    :param context: Plugin context, see plugin_init above.
+    :param user_ids: Unique identifiers
+    :param raise_on_missing: Raise UserDoesNotExist if any of the users is missing,
+                             instead of returning an UserDoesNotExist for them.
+
+    :type context: ToUAMPContext
+    :type user_ids: list of ObjectId
+    :type raise_on_missing: bool
+
+    :return: update dict, or UserDoesNotExist exception, per user id
+    :rtype: dict
+    """
+    users = {}
+    unchanged = []
+    for doc in context.tou_userdb._coll.find({'_id': {'$in': list(user_ids)}}):
+        unchanged.append(_unchanged_filter(doc['_id'], doc.get('tou', [])))
+        user = ToUUser(data=doc)
+        users[user.user_id] = user
+
+    missing = [user_id for user_id in user_ids if user_id not in users]
+    if missing and raise_on_missing:
+        raise UserDoesNotExist("No users matching _id in {!r}".format(missing))
+
+    central_event_ids = _get_central_event_ids(context, list(users.keys()))
+    res = {}
+    for user_id in user_ids:
+        if user_id in users:
+            res[user_id] = _build_update(users[user_id], central_event_ids.get(user_id))
+        else:
+            res[user_id] = UserDoesNotExist("No user matching _id='%s'" % user_id)
+
+    if unchanged:
+        try:
+            context.tou_userdb._coll.delete_many({'$or': unchanged})
+        except pymongo.errors.OperationFailure:
+            # See attribute_fetcher above
+            pass
+
+    return res
+
+
+def _get_central_event_ids(context, user_ids):
+    """
+    Get the ids of the ToU events already in the central userdb, for the given users.
+
+    :return: set of event ids per user id, or an empty dict if there is no central userdb
+    :rtype: dict
+    """
+    if context.userdb is None or not user_ids:
+        return {}
+    res = {user_id: set() for user_id in user_ids}
+    for doc in context.userdb._coll.find({'_id': {'$in': user_ids}}, projection={'tou.event_id': True}):
+        res[doc['_id']] = set([event.get('event_id') for event in doc.get('tou', [])])
+    return res
+
+
+def _unchanged_filter(user_id, events):
+    """
+    Filter matching a user in the ToU private userdb only if it still has just
+    the given events, so that a user is not removed if an event was added (e.g.
+    by a new acceptance) after it was checked.
+    """
+    if not events:
+        return {'_id': user_id, 'tou': {'$in': [None, []]}}
+    return {'_id': user_id,
+            'tou': {'$size': len(events)},
+            'tou.event_id': {'$all': [event.get('event_id') for event in events]},
+            }
+
+
+def _build_update(user, central_event_ids=None):
+    """
+    Build the update for the central userdb. If the ids of the ToU events already in
+    the central userdb are known, only the new events are added, otherwise the whole
+    list of events is set.
+
+    The new events are added with $addToSet, so that two syncs of the same user
+    that both read the central userdb before either has written can't add an
+    event twice. If there are no new events, the update adds an empty list of
+    events, which is a valid update that changes nothing (pymongo refuses an
+    empty update document).
+
+    :param user: User from the ToU private userdb
+    :param central_event_ids: Ids of the ToU events in the central userdb
+
+    :type user: eduid_userdb.actions.tou.ToUUser
+    :type central_event_ids: set | None
+
+    :return: update dict
+    :rtype: dict
+    """
+    tous = user.tou.to_list_of_dicts()
+    if central_event_ids is not None:
+        tous = [this for this in tous if this.get('event_id') not in central_event_ids]
+
+    import pprint
+    logger.debug("Processing user {}:\nToUs: {!r}".format(user,
+        pprint.pformat(tous)))
+
+    if central_event_ids is None:
+        return {'$set': {'tou': tous}}
+    return {'$addToSet': {'tou': {'$each': tous}}}
@@ -0,0 +1,71 @@
+#
+# Copyright (c) 2019 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+from datetime import datetime
+
+from eduid_userdb.actions.tou import ToUUserDB as BaseToUUserDB
+
+
+class ToUUserDB(BaseToUUserDB):
+    """
+    The ToU private userdb, with targeted updates of the ToU events of a user
+    (see TOU_PARTIAL_UPDATES), instead of saving the whole user.
+    """
+
+    def add_tou_event(self, user, event):
+        """
+        Add a ToU event to the user with an atomic $push, creating the user
+        if it isn't in this db.
+
+        :param user: the user accepting the ToU
+        :param event: the acceptance
+        :type user: eduid_userdb.User
+        :type event: eduid_userdb.tou.ToUEvent
+        """
+        self._coll.update_one({'_id': user.user_id},
+                              {'$push': {'tou': event.to_dict()},
+                               '$set': {'modified_ts': datetime.utcnow()},
+                               '$setOnInsert': {'eduPersonPrincipalName': user.eppn},
+                               },
+                              upsert=True)
+
+    def remove_tou_event(self, user_id, event_id):
+        """
+        Remove a ToU event from the user with an atomic $pull, undoing add_tou_event.
+
+        :type user_id: bson.ObjectId
+        :type event_id: bson.ObjectId
+        """
+        self._coll.update_one({'_id': user_id},
+                              {'$pull': {'tou': {'event_id': event_id}},
+                               '$set': {'modified_ts': datetime.utcnow()},
+                               })
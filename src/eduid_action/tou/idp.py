@@ -32,8 +32,23 @@
 
 __author__ = 'eperez'
 
+import logging
 
-def add_actions(idp_app, user, ticket):
+from pymongo.errors import DuplicateKeyError
+
+from eduid_action.common.cache import LRUCache
+from eduid_action.common.idp import action_spec
+
+logger = logging.getLogger(__name__)
+
+# (eppn, version) of users known to have a pending ToU action, see _get_pending_cache
+_pending_cache = None
+
+# Name of the unique index on ToU actions, see ensure_tou_action_index
+TOU_ACTION_INDEX = 'eduid_action-tou-unique'
+
+
+def add_actions(idp_app, user, ticket, context=None):
     """
     Add an action requiring the user to accept a new version of the Terms of Use,
     in case the IdP configuration points to a version the user hasn't accepted.
@@ -44,29 +59,144 @@ def add_actions(idp_app, user, ticket):
     :param idp_app: IdP application instance
     :param user: the authenticating user
     :param ticket: the SSO login data
+    :param context: the actions of the user, shared by all plugins
 
     :type idp_app: eduid_idp.idp.IdPApplication
     :type user: eduid_idp.idp_user.IdPUser
     :type ticket: eduid_idp.login.SSOLoginData
+    :type context: eduid_action.common.idp.IdPActionsContext | None
 
     :return: None
     """
     version = idp_app.config.tou_version
 
+    pending_cache = _get_pending_cache(idp_app)
+
     if user.tou.has_accepted(version):
         idp_app.logger.debug('User has already accepted ToU version {!r}'.format(version))
+        if pending_cache is not None:
+            pending_cache.invalidate((user.eppn, version))
         return
 
     if not idp_app.actions_db:
         idp_app.logger.warning('No actions_db - aborting ToU action')
         return None
 
-    if not idp_app.actions_db.has_actions(user.eppn,
-                                          action_type = 'tou',
-                                          params = {'version': version}):
+    if pending_cache is not None and pending_cache.get((user.eppn, version)):
+        idp_app.logger.debug('User has a pending action for ToU version {!r}'.format(version))
+        return
+
+    if context is not None and not context.has_actions(action_type='tou', params={'version': version}):
         idp_app.logger.debug('User must accept ToU version {!r}'.format(version))
-        idp_app.actions_db.add_action(
-            user.eppn,
-            action_type = 'tou',
-            preference = 100,
-            params = {'version': version})
+        spec, update = _tou_action_upsert(user.eppn, version)
+        context.add_action('tou', preference=update['$setOnInsert']['preference'],
+                           params=spec['params'], unique=True)
+        if pending_cache is not None:
+            # the action is only queued, so wait until it has been written before
+            # skipping the lookup on later logins
+            context.on_flush(lambda: pending_cache.set((user.eppn, version), True))
+        return
+    if context is None and ensure_tou_action(idp_app.actions_db, user.eppn, version):
+        idp_app.logger.debug('User must accept ToU version {!r}'.format(version))
+    if pending_cache is not None:
+        pending_cache.set((user.eppn, version), True)
+
+
+def _get_pending_cache(idp_app):
+    """
+    Return the cache of pending ToU actions, used to avoid looking for the
+    ToU action in the database on every login of users that haven't accepted
+    the ToU yet. Entries are kept for `tou_action_cache_ttl' seconds
+    (disabled by default, since a user with a cached entry is not prompted
+    again until it expires, even if the action has been removed).
+
+    :param idp_app: IdP application instance
+    :type idp_app: eduid_idp.idp.IdPApplication
+
+    :return: the cache, or None if disabled
+    :rtype: eduid_action.common.cache.LRUCache | None
+    """
+    global _pending_cache
+    ttl = getattr(idp_app.config, 'tou_action_cache_ttl', 0)
+    if not ttl:
+        return None
+    if _pending_cache is None or _pending_cache.ttl != ttl:
+        size = getattr(idp_app.config, 'tou_action_cache_size', 10000)
+        _pending_cache = LRUCache(maxsize=size, ttl=ttl)
+    return _pending_cache
+
+
+def invalidate_pending_tou_action(eppn=None, version=None):
+    """
+    Forget that a user has a pending ToU action, or all such users.
+
+    :param eppn: the eppn of the user, or None for all users
+    :param version: the ToU version
+    """
+    if _pending_cache is None:
+        return
+    if eppn is None:
+        _pending_cache.clear()
+    else:
+        _pending_cache.invalidate((eppn, version))
+
+
+def ensure_tou_action(actions_db, eppn, version):
+    """
+    Make sure there is an action requiring the user to accept a ToU version,
+    by upserting it in a single (idempotent) database operation, backed by the
+    unique index created by ensure_tou_action_index (which is not created here,
+    since building it would block the actions database during logins).
+
+    :param actions_db: The actions database
+    :param eppn: the eppn of the user
+    :param version: the ToU version
+
+    :type actions_db: eduid_userdb.actions.ActionDB
+    :type eppn: str
+    :type version: str
+
+    :return: Whether a new action was added
+    :rtype: bool
+    """
+    spec, update = _tou_action_upsert(eppn, version)
+    try:
+        result = actions_db._coll.update_one(spec, update, upsert=True)
+    except DuplicateKeyError:
+        # a concurrent upsert inserted the action first
+        return False
+    return result.upserted_id is not None
+
+
+def ensure_tou_action_index(actions_db):
+    """
+    Make sure there is a unique index on the ToU actions, by user and ToU
+    version. Upserts are only free of races with such an index: without it,
+    two concurrent upserts can both insert an action.
+
+    Old format ToU actions (with user_oid instead of eppn) are left out of the
+    index, since they would all collide on a missing eppn.
+
+    This is not done on the login path, since building the index may block the
+    actions database. Run `eduid_action_tou_maintenance create-index' when
+    deploying instead.
+
+    :param actions_db: The actions database
+    :type actions_db: eduid_userdb.actions.ActionDB
+
+    :raise: pymongo.errors.OperationFailure, e.g. if there are duplicate ToU actions
+            added before the index was introduced, that have to be removed by hand
+    """
+    actions_db._coll.create_index([('eppn', 1), ('action', 1), ('params.version', 1)],
+                                  name=TOU_ACTION_INDEX, unique=True,
+                                  partialFilterExpression={'action': 'tou', 'eppn': {'$exists': True}})
+
+
+def _tou_action_upsert(eppn, version):
+    """
+    Filter and update to upsert a ToU action. The fields in the filter are
+    copied to the document when it is inserted.
+    """
+    spec = action_spec(eppn, 'tou', params={'version': version})
+    update = {'$setOnInsert': {'preference': 100}}
+    return spec, update
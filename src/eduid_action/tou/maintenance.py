@@ -0,0 +1,226 @@
+#
+# Copyright (c) 2019 SUNET
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#     2. Redistributions in binary form must reproduce the above
+#        copyright notice, this list of conditions and the following
+#        disclaimer in the documentation and/or other materials provided
+#        with the distribution.
+#     3. Neither the name of the NORDUnet nor the names of its
+#        contributors may be used to endorse or promote products derived
+#        from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Maintenance tasks for the ToU plugin, to be run from cron or by hand.
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from eduid_userdb.actions import ActionDB
+
+from eduid_action.common.batch import chunked, unordered_bulk_write, RateLimiter
+from eduid_action.tou.am import plugin_init, _get_central_event_ids, _unchanged_filter
+from eduid_action.tou.idp import TOU_ACTION_INDEX, ensure_tou_action_index, _tou_action_upsert
+
+logger = logging.getLogger(__name__)
+
+
+def sweep_synced_users(context, chunk_size=1000, rate=None, limit=None):
+    """
+    Remove users from the ToU private userdb whose ToU events are all in the
+    central userdb already. These are normally removed by the AM plugin, but are
+    left behind when it can't write to the private userdb.
+
+    The private userdb is read with a cursor in chunks of `chunk_size' users, and
+    the synced users in each chunk are removed with a single delete.
+
+    :param context: AM plugin context, see eduid_action.tou.am.plugin_init
+    :param chunk_size: number of users to check at a time
+    :param rate: maximum number of users to check per second, or None for no limit
+    :param limit: stop after checking this many users
+
+    :type context: eduid_action.tou.am.ToUAMPContext
+    :type chunk_size: int
+    :type rate: float | None
+    :type limit: int | None
+
+    :return: number of users checked, removed and kept, and chunks processed
+    :rtype: dict
+    """
+    stats = {'checked': 0, 'removed': 0, 'kept': 0, 'chunks': 0}
+    limiter = RateLimiter(rate)
+    started = time.monotonic()
+    coll = context.tou_userdb._coll
+    with coll.find({}, projection={'tou.event_id': True}, batch_size=chunk_size,
+                   no_cursor_timeout=True) as cursor:
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        for chunk in chunked(cursor, chunk_size):
+            limiter.wait(len(chunk))
+            user_ids = [doc['_id'] for doc in chunk]
+            central_event_ids = _get_central_event_ids(context, user_ids)
+            synced = []
+            for doc in chunk:
+                events = doc.get('tou', [])
+                event_ids = set([event.get('event_id') for event in events])
+                if event_ids <= central_event_ids.get(doc['_id'], set()):
+                    synced.append(_unchanged_filter(doc['_id'], events))
+            removed = 0
+            if synced:
+                removed = coll.delete_many({'$or': synced}).deleted_count
+            stats['chunks'] += 1
+            stats['checked'] += len(chunk)
+            stats['removed'] += removed
+            stats['kept'] += len(chunk) - removed
+            logger.info('Checked {checked} users ({removed} removed, {kept} kept) in {chunks} chunks, '
+                        '{elapsed:.1f} seconds'.format(elapsed=time.monotonic() - started, **stats))
+    return stats
+
+
+def preseed_tou_actions(context, actions_db, version, chunk_size=1000, rate=None, limit=None,
+                        checkpoint=None):
+    """
+    Add a ToU action for every user in the central userdb that hasn't accepted
+    the given ToU version, so that the IdP doesn't need to add them at login
+    time when a new version is configured there.
+
+    The users are read ordered by _id, and the actions for each chunk of users
+    are upserted with a single unordered bulk write, using the same spec and
+    unique index as the IdP (see eduid_action.tou.idp.ensure_tou_action), so
+    running this more than once, or concurrently with the IdP, never adds
+    duplicate actions.
+
+    If a `checkpoint' file is given, the _id of the last user processed is
+    written to it after each chunk, and a new run starts after that user.
+
+    :param context: AM plugin context, see eduid_action.tou.am.plugin_init
+    :param actions_db: The actions database
+    :param version: the ToU version the users must accept
+    :param chunk_size: number of users to process at a time
+    :param rate: maximum number of users to process per second, or None for no limit
+    :param limit: stop after processing this many users
+    :param checkpoint: path to the checkpoint file, or None
+
+    :type context: eduid_action.tou.am.ToUAMPContext
+    :type actions_db: eduid_userdb.actions.ActionDB
+    :type version: str | unicode
+    :type chunk_size: int
+    :type rate: float | None
+    :type limit: int | None
+    :type checkpoint: str | None
+
+    :return: number of users checked, actions added, and chunks processed
+    :rtype: dict
+    """
+    stats = {'checked': 0, 'added': 0, 'chunks': 0}
+    limiter = RateLimiter(rate)
+    started = time.monotonic()
+    # The same as "not user.tou.has_accepted(version)", evaluated by the database
+    spec = {'tou.version': {'$ne': version}}
+    last_id = _read_checkpoint(checkpoint)
+    if last_id is not None:
+        logger.info('Resuming after user {!s}'.format(last_id))
+        spec['_id'] = {'$gt': last_id}
+    ensure_tou_action_index(actions_db)
+    coll = context.userdb._coll
+    with coll.find(spec, projection={'eduPersonPrincipalName': True}, sort=[('_id', 1)],
+                   batch_size=chunk_size, no_cursor_timeout=True) as cursor:
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        for chunk in chunked(cursor, chunk_size):
+            limiter.wait(len(chunk))
+            requests = [UpdateOne(*_tou_action_upsert(doc['eduPersonPrincipalName'], version), upsert=True)
+                        for doc in chunk if doc.get('eduPersonPrincipalName')]
+            if requests:
+                stats['added'] += unordered_bulk_write(actions_db._coll, requests)
+            _write_checkpoint(checkpoint, chunk[-1]['_id'])
+            stats['chunks'] += 1
+            stats['checked'] += len(chunk)
+            logger.info('Checked {checked} users ({added} actions added) in {chunks} chunks, '
+                        '{elapsed:.1f} seconds'.format(elapsed=time.monotonic() - started, **stats))
+    return stats
+
+
+def _read_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as fd:
+        value = fd.read().strip()
+    return ObjectId(value) if value else None
+
+
+def _write_checkpoint(path, user_id):
+    if not path:
+        return
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as fd:
+        fd.write('{!s}\n'.format(user_id))
+    os.rename(tmp, path)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='eduID ToU plugin maintenance')
+    parser.add_argument('--mongo-uri', required=True, help='MongoDB URI')
+    parser.add_argument('--debug', action='store_true', default=False)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    subparsers.add_parser('create-index', help='Create the unique index on ToU actions used by the IdP')
+
+    sweep = subparsers.add_parser('sweep', help='Remove already synced users from the ToU private userdb')
+    sweep.add_argument('--chunk-size', type=int, default=1000)
+    sweep.add_argument('--rate', type=float, default=None, help='Maximum number of users per second')
+    sweep.add_argument('--limit', type=int, default=None, help='Maximum number of users to check')
+
+    preseed = subparsers.add_parser('preseed', help='Add ToU actions for users that have not accepted a ToU version')
+    preseed.add_argument('--version', required=True, help='ToU version the users must accept')
+    preseed.add_argument('--chunk-size', type=int, default=1000)
+    preseed.add_argument('--rate', type=float, default=None, help='Maximum number of users per second')
+    preseed.add_argument('--limit', type=int, default=None, help='Maximum number of users to process')
+    preseed.add_argument('--checkpoint', default=None, help='File to resume from and record progress in')
+
+    opts = parser.parse_args(args)
+    logging.basicConfig(level=logging.DEBUG if opts.debug else logging.INFO)
+
+    context = plugin_init({'MONGO_URI': opts.mongo_uri})
+    if opts.command == 'create-index':
+        ensure_tou_action_index(ActionDB(opts.mongo_uri))
+        logger.info('Done: index {} created'.format(TOU_ACTION_INDEX))
+    elif opts.command == 'sweep':
+        stats = sweep_synced_users(context, chunk_size=opts.chunk_size, rate=opts.rate, limit=opts.limit)
+        logger.info('Done: {!r}'.format(stats))
+    elif opts.command == 'preseed':
+        actions_db = ActionDB(opts.mongo_uri)
+        stats = preseed_tou_actions(context, actions_db, opts.version, chunk_size=opts.chunk_size,
+                                    rate=opts.rate, limit=opts.limit, checkpoint=opts.checkpoint)
+        logger.info('Done: {!r}'.format(stats))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
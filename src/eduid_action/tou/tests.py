@@ -35,16 +35,28 @@ from __future__ import absolute_import
 __author__ = 'eperez'
 
 
+import os
 import json
+import shutil
+import tempfile
 import unittest
 from mock import patch
 from datetime import datetime
 from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
 from eduid_userdb.tou import ToUEvent
 from eduid_action.common.testing import MockIdPApp
 from eduid_action.common.testing import ActionsTestCase
-from eduid_action.tou.action import Plugin
-from eduid_action.tou.idp import add_actions
+from eduid_action.tou.action import Plugin, invalidate_tou_cache
+from eduid_action.tou import idp as idp_module
+from eduid_action.tou.idp import add_actions, ensure_tou_action, ensure_tou_action_index, \
+    invalidate_pending_tou_action
+from eduid_action.tou.am import ToUAMPContext, attribute_fetcher_bulk
+from eduid_action.tou import am
+from eduid_action.tou import maintenance
+from eduid_action.tou.maintenance import sweep_synced_users, preseed_tou_actions
+from eduid_userdb.actions.tou import ToUUser
+from eduid_userdb.exceptions import UserDoesNotExist
 
 
 TOU_ACTION = {
@@ -109,6 +121,55 @@ class ToUActionPluginTests(ActionsTestCase):
                 data = json.loads(response.data)
                 self.assertEquals(data['action'], False)
 
+    def test_ensure_tou_action(self):
+        self.assertTrue(ensure_tou_action(self.app.actions_db, self.user.eppn, 'test-version'))
+        self.assertFalse(ensure_tou_action(self.app.actions_db, self.user.eppn, 'test-version'))
+        self.assertTrue(self.app.actions_db.has_actions(self.user.eppn, action_type='tou',
+                                                        params={'version': 'test-version'}))
+        actions = list(self.app.actions_db._coll.find({'eppn': self.user.eppn, 'action': 'tou'}))
+        self.assertEqual(len(actions), 1)
+        self.assertEqual(actions[0]['preference'], 100)
+
+    def test_ensure_tou_action_unique_index(self):
+        ensure_tou_action_index(self.app.actions_db)
+        self.assertIn(idp_module.TOU_ACTION_INDEX, self.app.actions_db._coll.index_information())
+        self.assertTrue(ensure_tou_action(self.app.actions_db, self.user.eppn, 'test-version'))
+        # a concurrent upsert that inserted a second action would be refused by the index
+        with self.assertRaises(DuplicateKeyError):
+            self.app.actions_db._coll.insert_one({'eppn': self.user.eppn, 'action': 'tou',
+                                                  'params': {'version': 'test-version'}, 'preference': 100})
+        # and losing such a race is not an error
+        with patch.object(self.app.actions_db._coll, 'update_one', side_effect=DuplicateKeyError('dup')):
+            self.assertFalse(ensure_tou_action(self.app.actions_db, self.user.eppn, 'test-version'))
+        # old format actions, without eppn, are not covered by the index
+        for _ in range(2):
+            self.app.actions_db._coll.insert_one({'user_oid': ObjectId(), 'action': 'tou',
+                                                  'params': {'version': 'test-version'}, 'preference': 100})
+
+    def test_add_actions_does_not_create_index(self):
+        mock_idp_app = MockIdPApp(self.app.actions_db, tou_version='test-version')
+        add_actions(mock_idp_app, self.user, None)
+        self.assertNotIn(idp_module.TOU_ACTION_INDEX, self.app.actions_db._coll.index_information())
+
+    def test_pending_tou_action_cache(self):
+        mock_idp_app = MockIdPApp(self.app.actions_db, tou_version='test-version', tou_action_cache_ttl=30)
+        invalidate_pending_tou_action()
+        with patch('eduid_action.tou.idp.ensure_tou_action', wraps=ensure_tou_action) as mock_ensure:
+            add_actions(mock_idp_app, self.user, None)
+            add_actions(mock_idp_app, self.user, None)
+            self.assertEqual(mock_ensure.call_count, 1)
+            self.assertTrue(self.app.actions_db.has_actions(self.user.eppn, action_type='tou',
+                                                            params={'version': 'test-version'}))
+            invalidate_pending_tou_action(self.user.eppn, 'test-version')
+            add_actions(mock_idp_app, self.user, None)
+            self.assertEqual(mock_ensure.call_count, 2)
+            # accepting the ToU forgets the pending action
+            self.tou_accepted('test-version')
+            add_actions(mock_idp_app, self.user, None)
+            self.assertEqual(mock_ensure.call_count, 2)
+            self.assertIsNone(idp_module._pending_cache.get((self.user.eppn, 'test-version')))
+        invalidate_pending_tou_action()
+
     def test_get_config(self):
         with self.session_cookie(self.browser) as client:
             with self.app.test_request_context():
@@ -122,6 +183,47 @@ class ToUActionPluginTests(ActionsTestCase):
                 data = json.loads(response.data.decode('utf-8'))
                 self.assertEquals(data['payload']['tous']['sv'], 'test tou svenska')
 
+    def test_get_config_cached(self):
+        with self.session_cookie(self.browser) as client:
+            with self.app.test_request_context():
+                mock_idp_app = MockIdPApp(self.app.actions_db, tou_version='test-version')
+                add_actions(mock_idp_app, self.user, None)
+                with client.session_transaction() as sess:
+                    self.authenticate(client, sess)
+                response = client.get('/get-actions')
+                self.assertEqual(response.status_code, 200)
+                self.app.tou_cache.clear()
+                with patch.object(self.app, 'get_tous', wraps=self.app.get_tous) as mock_get_tous:
+                    for _ in range(2):
+                        response = client.get('/config')
+                        data = json.loads(response.data.decode('utf-8'))
+                        self.assertEquals(data['payload']['tous']['sv'], 'test tou svenska')
+                    self.assertEqual(mock_get_tous.call_count, 1)
+                    self.assertEqual(self.app.tou_cache.stats['hits'], 1)
+                    invalidate_tou_cache('test-version')
+                    client.get('/config')
+                    self.assertEqual(mock_get_tous.call_count, 2)
+
+    def test_get_config_negotiated_language(self):
+        self.app.config['TOU_NEGOTIATE_LANGUAGE'] = True
+        with self.session_cookie(self.browser) as client:
+            with self.app.test_request_context():
+                mock_idp_app = MockIdPApp(self.app.actions_db, tou_version='test-version')
+                add_actions(mock_idp_app, self.user, None)
+                with client.session_transaction() as sess:
+                    self.authenticate(client, sess)
+                response = client.get('/get-actions')
+                self.assertEqual(response.status_code, 200)
+                response = client.get('/config', headers={'Accept-Language': 'sv,en;q=0.5'})
+                data = json.loads(response.data.decode('utf-8'))
+                self.assertEquals(data['payload']['tous'], {'sv': 'test tou svenska'})
+                self.assertEquals(data['payload']['language'], 'sv')
+                self.assertIn('en', data['payload']['available_languages'])
+                # other languages can be fetched explicitly
+                response = client.get('/config?lang=en', headers={'Accept-Language': 'sv'})
+                data = json.loads(response.data.decode('utf-8'))
+                self.assertEquals(list(data['payload']['tous'].keys()), ['en'])
+
     def test_get_config_no_tous(self):
         with self.session_cookie(self.browser) as client:
             with self.app.test_request_context():
@@ -167,3 +269,286 @@ class ToUActionPluginTests(ActionsTestCase):
                 self.assertEquals(response.status_code, 200)
                 data = json.loads(response.data)
                 self.assertEquals(data['payload']['message'], 'tou.must-accept')
+
+    @patch('eduid_am.tasks.update_attributes_keep_result')
+    def test_accept_tou_async(self, mock_update):
+        self.app.config['TOU_ASYNC_SYNC'] = True
+        mock_update.delay.return_value.id = 'test-task-id'
+        mock_result = mock_update.AsyncResult.return_value
+        mock_result.ready.return_value = False
+        with self.session_cookie(self.browser) as client:
+            self.prepare(client, Plugin, 'tou', action_dict=TOU_ACTION, total_steps=2)
+            with self.app.test_request_context():
+                with client.session_transaction() as sess:
+                    csrf_token = sess.get_csrf_token()
+                data = json.dumps({'accept': True, 'csrf_token': csrf_token})
+                response = client.post('/post-action', data=data, content_type=self.content_type_json)
+                self.assertEquals(response.status_code, 200)
+                # the sync was requested, but not waited for
+                self.assertTrue(mock_update.delay.called)
+                self.assertFalse(mock_update.delay.return_value.get.called)
+                with client.session_transaction() as sess:
+                    self.assertEqual(sess['eduid_action.tou.pending_sync']['task_id'], 'test-task-id')
+
+                # polling while the sync is running keeps the client on the last step
+                data = json.dumps({'csrf_token': csrf_token})
+                response = client.post('/post-action', data=data, content_type=self.content_type_json)
+                self.assertEquals(response.status_code, 200)
+                data = json.loads(response.data)
+                self.assertEqual(data['payload']['data'], {'pending': True})
+                self.assertNotIn('message', data['payload'])
+                with client.session_transaction() as sess:
+                    self.assertEqual(sess['current_step'], 2)
+
+                mock_result.ready.return_value = True
+                mock_result.successful.return_value = True
+                data = json.dumps({'csrf_token': csrf_token})
+                response = client.post('/post-action', data=data, content_type=self.content_type_json)
+                self.assertEquals(response.status_code, 200)
+                data = json.loads(response.data)
+                self.assertEquals(data['payload']['message'], "actions.action-completed")
+                mock_update.AsyncResult.assert_called_with('test-task-id')
+                self.assertFalse(self.app.actions_db.has_actions(self.user.eppn, action_type='tou'))
+
+    @patch('eduid_am.tasks.update_attributes_keep_result')
+    def test_accept_tou_async_compensation(self, mock_update):
+        self.app.config['TOU_ASYNC_SYNC'] = True
+        mock_update.delay.return_value.id = 'test-task-id'
+        mock_result = mock_update.AsyncResult.return_value
+        with self.session_cookie(self.browser) as client:
+            self.prepare(client, Plugin, 'tou', action_dict=TOU_ACTION, total_steps=2)
+            with self.app.test_request_context():
+                with client.session_transaction() as sess:
+                    csrf_token = sess.get_csrf_token()
+                data = json.dumps({'accept': True, 'csrf_token': csrf_token})
+                response = client.post('/post-action', data=data, content_type=self.content_type_json)
+                self.assertEquals(response.status_code, 200)
+                tou_user = self.tou_db.get_user_by_id(self.user.user_id)
+                self.assertTrue(tou_user.tou.has_accepted(TOU_ACTION['params']['version']))
+
+                # The browser is closed, the sync fails, and the action is started again
+                # in a new session, from the action in the db
+                action = self.app.actions_db._coll.find_one({'_id': TOU_ACTION['_id']})
+                self.assertEqual(action['result']['pending_sync']['task_id'], 'test-task-id')
+                action['_id'] = str(action['_id'])
+                with client.session_transaction() as sess:
+                    del sess['eduid_action.tou.pending_sync']
+                    sess['current_action'] = action
+                    sess['current_step'] = 1
+                mock_result.ready.return_value = True
+                mock_result.successful.return_value = False
+                response = client.get('/config')
+                self.assertEquals(response.status_code, 200)
+                tou_user = self.tou_db.get_user_by_id(self.user.user_id)
+                self.assertFalse(tou_user.tou.has_accepted(TOU_ACTION['params']['version']))
+                action = self.app.actions_db._coll.find_one({'_id': TOU_ACTION['_id']})
+                self.assertIsNone(action.get('result'))
+
+    @patch('eduid_am.tasks.update_attributes_keep_result')
+    def test_accept_tou_async_done_before_config(self, mock_update):
+        self.app.config['TOU_ASYNC_SYNC'] = True
+        mock_update.delay.return_value.id = 'test-task-id'
+        mock_result = mock_update.AsyncResult.return_value
+        with self.session_cookie(self.browser) as client:
+            self.prepare(client, Plugin, 'tou', action_dict=TOU_ACTION, total_steps=2)
+            with self.app.test_request_context():
+                with client.session_transaction() as sess:
+                    csrf_token = sess.get_csrf_token()
+                data = json.dumps({'accept': True, 'csrf_token': csrf_token})
+                client.post('/post-action', data=data, content_type=self.content_type_json)
+
+                # The page is reloaded after the sync has finished
+                action = self.app.actions_db._coll.find_one({'_id': TOU_ACTION['_id']})
+                action['_id'] = str(action['_id'])
+                with client.session_transaction() as sess:
+                    sess['current_action'] = action
+                    sess['current_step'] = 1
+                mock_result.ready.return_value = True
+                mock_result.successful.return_value = True
+                response = client.get('/config')
+                data = json.loads(response.data.decode('utf-8'))
+                self.assertTrue(data['payload']['completed'])
+                self.assertFalse(self.app.actions_db.has_actions(self.user.eppn, action_type='tou'))
+                tou_user = self.tou_db.get_user_by_id(self.user.user_id)
+                self.assertTrue(tou_user.tou.has_accepted(TOU_ACTION['params']['version']))
+
+                # and the client moves on without asking the user again
+                response = client.get('/redirect-action')
+                self.assertEquals(response.status_code, 302)
+
+    def test_accept_tou_partial_update(self):
+        self.app.config['TOU_PARTIAL_UPDATES'] = True
+        with self.session_cookie(self.browser) as client:
+            self.prepare(client, Plugin, 'tou', action_dict=TOU_ACTION)
+            with self.app.test_request_context():
+                with client.session_transaction() as sess:
+                    csrf_token = sess.get_csrf_token()
+                data = json.dumps({'accept': True, 'csrf_token': csrf_token})
+                response = client.post('/post-action', data=data, content_type=self.content_type_json)
+                self.assertEquals(response.status_code, 200)
+                data = json.loads(response.data)
+                self.assertEquals(data['payload']['message'], "actions.action-completed")
+                user = self.app.central_userdb.get_user_by_eppn(self.user.eppn)
+                self.assertTrue(user.tou.has_accepted(TOU_ACTION['params']['version']))
+
+    def test_tou_db_targeted_updates(self):
+        event_id = ObjectId()
+        event = ToUEvent(version='test-version', application='eduid_tou_plugin',
+                         created_ts=datetime.utcnow(), event_id=event_id)
+        self.tou_db.add_tou_event(self.user, event)
+        doc = self.tou_db._coll.find_one({'_id': self.user.user_id})
+        self.assertEqual(doc['eduPersonPrincipalName'], self.user.eppn)
+        self.assertEqual([this['event_id'] for this in doc['tou']], [event_id])
+        modified_ts = doc['modified_ts']
+        self.tou_db.remove_tou_event(self.user.user_id, event_id)
+        doc = self.tou_db._coll.find_one({'_id': self.user.user_id})
+        self.assertEqual(doc['tou'], [])
+        self.assertGreaterEqual(doc['modified_ts'], modified_ts)
+
+    @patch('eduid_am.tasks.update_attributes_keep_result')
+    def test_accept_tou_partial_update_sync_problem(self, mock_update):
+        self.app.config['TOU_PARTIAL_UPDATES'] = True
+        mock_update.delay.return_value.get.side_effect = Exception('sync failed')
+        with self.session_cookie(self.browser) as client:
+            self.prepare(client, Plugin, 'tou', action_dict=TOU_ACTION)
+            with self.app.test_request_context():
+                with client.session_transaction() as sess:
+                    csrf_token = sess.get_csrf_token()
+                data = json.dumps({'accept': True, 'csrf_token': csrf_token})
+                response = client.post('/post-action', data=data, content_type=self.content_type_json)
+                self.assertEquals(response.status_code, 200)
+                data = json.loads(response.data)
+                self.assertEquals(data['payload']['message'], 'tou.sync-problem')
+                # the event was pushed to the ToU db, and pulled again
+                doc = self.tou_db._coll.find_one({'_id': self.user.user_id})
+                self.assertEqual(doc['eduPersonPrincipalName'], self.user.eppn)
+                self.assertEqual(doc['tou'], [])
+
+    def test_attribute_fetcher_bulk(self):
+        self.tou_accepted('test-version')
+        tou_user = ToUUser.from_user(self.user, self.tou_db)
+        self.tou_db.save(tou_user, check_sync=False)
+        context = ToUAMPContext(None)
+        context.tou_userdb = self.tou_db
+        missing_id = ObjectId()
+
+        res = attribute_fetcher_bulk(context, [self.user.user_id, missing_id])
+        self.assertEqual(res[self.user.user_id]['$set']['tou'][0]['version'], 'test-version')
+        self.assertIsInstance(res[missing_id], UserDoesNotExist)
+
+        # with access to the central userdb, only new events are pushed
+        tou_user.tou.add(ToUEvent(version='new-version', application='eduid_tou_plugin',
+                                  created_ts=datetime.utcnow(), event_id=ObjectId()))
+        self.tou_db.save(tou_user, check_sync=False)
+        context.userdb = self.app.central_userdb
+        res = attribute_fetcher_bulk(context, [self.user.user_id, missing_id])
+        update = res[self.user.user_id]
+        new_events = update['$addToSet']['tou']['$each']
+        self.assertEqual([event['version'] for event in new_events], ['new-version'])
+        # applying the same update twice (two concurrent syncs) adds the event once
+        self.app.central_userdb._coll.update_one({'_id': self.user.user_id}, update)
+        self.app.central_userdb._coll.update_one({'_id': self.user.user_id}, update)
+        central = self.app.central_userdb._coll.find_one({'_id': self.user.user_id})
+        self.assertEqual([event['version'] for event in central['tou']], ['test-version', 'new-version'])
+        self.assertIsInstance(res[missing_id], UserDoesNotExist)
+        # the synced user has been removed from the private db
+        self.assertIsNone(self.tou_db.get_user_by_id(self.user.user_id, raise_on_missing=False))
+
+        with self.assertRaises(UserDoesNotExist):
+            attribute_fetcher_bulk(context, [missing_id], raise_on_missing=True)
+
+        # a valid update that changes nothing when all events are in the central userdb already
+        self.tou_db.save(tou_user, check_sync=False)
+        res = attribute_fetcher_bulk(context, [self.user.user_id])
+        update = res[self.user.user_id]
+        self.assertEqual(update, {'$addToSet': {'tou': {'$each': []}}})
+        self.app.central_userdb._coll.update_one({'_id': self.user.user_id}, update)
+        central = self.app.central_userdb._coll.find_one({'_id': self.user.user_id})
+        self.assertEqual([event['version'] for event in central['tou']], ['test-version', 'new-version'])
+
+    def test_attribute_fetcher_bulk_concurrent_acceptance(self):
+        self.tou_accepted('test-version')
+        tou_user = ToUUser.from_user(self.user, self.tou_db)
+        self.tou_db.save(tou_user, check_sync=False)
+        context = ToUAMPContext(None)
+        context.tou_userdb = self.tou_db
+        context.userdb = self.app.central_userdb
+        new_event = ToUEvent(version='new-version', application='eduid_tou_plugin',
+                             created_ts=datetime.utcnow(), event_id=ObjectId())
+        get_central_event_ids = am._get_central_event_ids
+
+        def accept_while_fetching(context, user_ids):
+            # the user accepts a new version after the users have been read
+            self.tou_db._coll.update_one({'_id': self.user.user_id}, {'$push': {'tou': new_event.to_dict()}})
+            return get_central_event_ids(context, user_ids)
+
+        with patch('eduid_action.tou.am._get_central_event_ids', side_effect=accept_while_fetching):
+            attribute_fetcher_bulk(context, [self.user.user_id])
+        # the user is kept, with the new event, for its own sync
+        tou_user = self.tou_db.get_user_by_id(self.user.user_id)
+        self.assertTrue(tou_user.tou.has_accepted('new-version'))
+
+    def test_sweep_synced_users(self):
+        self.tou_accepted('test-version')
+        synced_user = ToUUser.from_user(self.user, self.tou_db)
+        self.tou_db.save(synced_user, check_sync=False)
+        unsynced_user = ToUUser(data={'_id': ObjectId(), 'eduPersonPrincipalName': 'lata-lata'})
+        unsynced_user.tou.add(ToUEvent(version='test-version', application='eduid_tou_plugin',
+                                       created_ts=datetime.utcnow(), event_id=ObjectId()))
+        self.tou_db.save(unsynced_user, check_sync=False)
+        context = ToUAMPContext(None)
+        context.tou_userdb = self.tou_db
+        context.userdb = self.app.central_userdb
+
+        stats = sweep_synced_users(context, chunk_size=1)
+        self.assertEqual(stats, {'checked': 2, 'removed': 1, 'kept': 1, 'chunks': 2})
+        self.assertIsNone(self.tou_db.get_user_by_id(self.user.user_id, raise_on_missing=False))
+        self.assertIsNotNone(self.tou_db.get_user_by_id(unsynced_user.user_id, raise_on_missing=False))
+
+    def test_sweep_synced_users_concurrent_acceptance(self):
+        self.tou_accepted('test-version')
+        synced_user = ToUUser.from_user(self.user, self.tou_db)
+        self.tou_db.save(synced_user, check_sync=False)
+        context = ToUAMPContext(None)
+        context.tou_userdb = self.tou_db
+        context.userdb = self.app.central_userdb
+        new_event = ToUEvent(version='new-version', application='eduid_tou_plugin',
+                             created_ts=datetime.utcnow(), event_id=ObjectId())
+        get_central_event_ids = maintenance._get_central_event_ids
+
+        def accept_while_sweeping(context, user_ids):
+            # the user accepts a new version after the chunk has been read
+            self.tou_db._coll.update_one({'_id': self.user.user_id}, {'$push': {'tou': new_event.to_dict()}})
+            return get_central_event_ids(context, user_ids)
+
+        with patch('eduid_action.tou.maintenance._get_central_event_ids', side_effect=accept_while_sweeping):
+            stats = sweep_synced_users(context)
+        self.assertEqual(stats, {'checked': 1, 'removed': 0, 'kept': 1, 'chunks': 1})
+        tou_user = self.tou_db.get_user_by_id(self.user.user_id)
+        self.assertTrue(tou_user.tou.has_accepted('new-version'))
+
+    def test_preseed_tou_actions(self):
+        self.tou_accepted('test-version')
+        context = ToUAMPContext(None)
+        context.tou_userdb = self.tou_db
+        context.userdb = self.app.central_userdb
+        pending = [doc['eduPersonPrincipalName'] for doc in
+                   self.app.central_userdb._coll.find({'tou.version': {'$ne': 'test-version'}})]
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        checkpoint = os.path.join(tmpdir, 'checkpoint')
+
+        stats = preseed_tou_actions(context, self.app.actions_db, 'test-version', checkpoint=checkpoint)
+        self.assertEqual(stats, {'checked': len(pending), 'added': len(pending), 'chunks': 1})
+        self.assertFalse(self.app.actions_db.has_actions(self.user.eppn, action_type='tou'))
+        for eppn in pending:
+            self.assertTrue(self.app.actions_db.has_actions(eppn, action_type='tou',
+                                                            params={'version': 'test-version'}))
+        # resuming from the checkpoint finds nothing left to do
+        stats = preseed_tou_actions(context, self.app.actions_db, 'test-version', checkpoint=checkpoint)
+        self.assertEqual(stats['checked'], 0)
+        # and running again from the start adds no duplicates
+        stats = preseed_tou_actions(context, self.app.actions_db, 'test-version', chunk_size=1)
+        self.assertEqual(stats['added'], 0)
+        self.assertEqual(len(list(self.app.actions_db._coll.find({'action': 'tou'}))), len(pending))
+        self.assertIn(idp_module.TOU_ACTION_INDEX, self.app.actions_db._coll.index_information())